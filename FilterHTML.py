@@ -1,5 +1,14 @@
+import codecs
+import collections
+import functools
+import hashlib
+import io
+import itertools
+import os
 import re
 import string
+import threading
+import time
 
 def p2to3isunicode(s, t):
    """ Helper for python 2/3 to detect unicode string """
@@ -15,21 +24,59 @@ def p2to3itervalues(g):
    except AttributeError:
       return g.values()
 
-def p2to3maketrans(a, b):
+def p2to3translate(s, table):
+   """ Helper for translating with a table of {ordinal: replacement}, which python 2 byte strings don't support """
    try:
-      return string.maketrans(a, b)
-   except AttributeError:
-      return str.maketrans(a, b)
+      return s.translate(table)
+   except TypeError:
+      return ''.join([table.get(ord(char), char) for char in s])
 
 PATTERN_TYPE = getattr(re, '_pattern_type', getattr(re, 'Pattern', None))
 
-TRANS_TABLE = p2to3maketrans('','')
+# regex syntax which changes meaning when a pattern is embedded in a larger one
+# (back-references, conditionals, and global inline flags)
+UNCOMBINABLE_PATTERN_MATCH = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
 
 TAG_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz123456")
 ATTR_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz-")
 UNQUOTED_INVALID_VALUES = frozenset("\"'`=<>")
+
+# runs of characters matched while scanning tags
+WHITESPACE_MATCH = re.compile(r'\s*')
+TAG_NAME_MATCH = re.compile(r'[a-zA-Z1-6]*')
+ATTRIBUTE_NAME_MATCH = re.compile(r'[a-zA-Z\-]*')
+UNQUOTED_VALUE_MATCH = re.compile(r'[^\s%s]*' % re.escape(''.join(sorted(UNQUOTED_INVALID_VALUES))))
 UNICODE_ESCAPE = '&#'
-CSS_ESCAPE = re.compile(r'^.*\\[0-9A-Fa-f].*$')
+CSS_SPECIAL_MATCH = re.compile(r'\\[\s\S]?|[;"\'()]') # escapes, and characters which group or separate style declarations
+FLAT_PARENTHESES_MATCH = re.compile(r'[^()]*(?:\([^()]*\)[^()]*)*\Z') # parentheses which aren't nested
+HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+DEFAULT_SCHEMES = ('http', 'https', 'mailto', 'ftp')
+# the most entries each cache holds before it's emptied
+MAX_DELEGATE_RESULTS = 256 # compiled tag specs returned by tag filtering functions, by object and by rules
+MAX_PURE_RESULTS = 256 # results of pure tag filtering functions, in one document
+MAX_PATTERN_RULES = 256 # attribute names looked up in a tag's regex attribute names
+MAX_CHAR_SET_PATTERNS = 256 # patterns for character set rules
+MAX_URL_MEMOS = 256 # url memos, one for each set of allowed schemes
+MAX_COMPILED_SPECS = 256 # compiled spec dictionaries given to HTMLFilter
+MAX_STYLE_PROPERTIES = 256 # compiled style rules given to HTMLFilter.purify_style
+MAX_MEMO_ENTRIES = 1024
+MAX_MEMO_VALUE_LENGTH = 64
+MAX_URL_MEMO_LENGTH = 256
+BATCH_CHUNKSIZE = 64
+WRITE_BUFFER_FRAGMENTS = 512
+DEADLINE_CHECK_TAGS = 32 # how many tags are filtered between checks of FilterLimits.time_limit
+TEXT_EXPANSION_ALLOWANCE = 256 # characters a text filter may add to any run of text, beyond FilterLimits.max_text_expansion
+ASYNC_INLINE_SIZE = 4096 # documents shorter than this are filtered without dispatching to an executor
+TIMER = getattr(time, 'perf_counter', time.time)
+
+# the stage that each built-in rule's time is counted under, when collecting FilterStats
+RULE_STAGES = {
+   "url": "purify_url",
+   "url|empty": "purify_url",
+   "color": "purify_color",
+   "text": "purify_text",
+}
+
 INVALID_ATTRIBUTE_REPLACEMENTS = {
    "url": "#",
    "url|empty": ""
@@ -48,6 +95,8 @@ UNSAFE_URL_CHARS = {
    "^": r"%5E"
 }
 
+UNSAFE_URL_TABLE = dict((ord(char), escaped) for char, escaped in UNSAFE_URL_CHARS.items())
+
 VOID_ELEMENTS = [
    'area',
    'base',
@@ -84,8 +133,23 @@ HTML_ESCAPE_QUOTES = {
    '\'': '&apos;',
 }
 
+HTML_ESCAPE_TABLE = dict((ord(char), escaped) for char, escaped in HTML_ESCAPE_CHARS.items())
+HTML_ESCAPE_QUOTES_TABLE = dict(HTML_ESCAPE_TABLE)
+HTML_ESCAPE_QUOTES_TABLE.update((ord(char), escaped) for char, escaped in HTML_ESCAPE_QUOTES.items())
+
+# character sets for "alpha" style rules: (allowed characters, whether empty values are allowed)
+CHARACTER_SET_RULES = {
+   "alpha": (string.ascii_letters, False),
+   "alphanumeric": (string.ascii_letters + string.digits, False),
+   "alpha|empty": (string.ascii_letters, True),
+   "alphanumeric|empty": (string.ascii_letters + string.digits, True),
+}
+
 URL_ENCODING_MATCH = re.compile(r'(\%[0-9a-fA-F]{2})')
 ENTITY_MATCH = re.compile(r'(\&[\#\d\w]+;)')
+PARTIAL_ENTITY_MATCH = re.compile(r'\&[\#\d\w]*\Z')
+CLEAN_TEXT_MATCH = re.compile(r'[^<>&;]*(?:\&[\#\d\w]+;[^<>&;]*)*\Z') # text without anything to escape, outside of entities
+ENTITY_CHARS_MATCH = re.compile(r'[\#\d\w]*\Z') # text which continues a partial entity
 
 # predefined HTML colors
 HTML_COLORS = frozenset([
@@ -242,6 +306,19 @@ HSL_MATCH = re.compile(r'^hsl\(\s*\d+\s*,\s*\d+%\s*,\s*\d+%\s*\)$')
 
 HSLA_MATCH = re.compile(r'^hsla\(\s*\d+\s*,\s*\d+%\s*,\s*\d+%\s*,\s*(\d+\.)?\d+\s*\)$')
 
+# all of the above formats for lower-case values, as one pattern which only tries the format(s) beginning with the first character
+COLOR_MATCH = re.compile(r'''^(?:
+   \#(?:[0-9a-f]{3}){1,2} |
+   rgb(?:
+      \(\s*\d+%?\s*,\s*\d+%?\s*,\s*\d+%?\s*\) |
+      a\(\s*\d+%?\s*,\s*\d+%?\s*,\s*\d+%?\s*,\s*(?:\d+\.)?\d+\s*\)
+   ) |
+   hsl(?:
+      \(\s*\d+\s*,\s*\d+%\s*,\s*\d+%\s*\) |
+      a\(\s*\d+\s*,\s*\d+%\s*,\s*\d+%\s*,\s*(?:\d+\.)?\d+\s*\)
+   )
+)$''', re.VERBOSE)
+
 MEASUREMENT_MATCH = re.compile(r'^(-?\d+(px|cm|pt|em|ex|pc|mm|in)?|\d+%)$')
 
 # states for navigating script tags (tag body contains "<" signs)
@@ -258,224 +335,2080 @@ class TagMismatchError(Exception):
 class HTMLSyntaxError(Exception):
    pass
 
+class LimitExceededError(Exception):
+   """ Raised when a document goes over one of a filter's FilterLimits, with the line and column where it did """
+   def __init__(self, message, limit=None, line=None, column=None):
+      super(LimitExceededError, self).__init__(message)
+      self.limit = limit
+      self.line = line
+      self.column = column
+
+   def __reduce__(self):
+      return (LimitExceededError, (self.args[0], self.limit, self.line, self.column))
+
+class FilterResult(collections.namedtuple('FilterResult', ['html', 'error'])):
+   """ The outcome of filtering one document of a batch: the filtered html, or the error it raised """
+   __slots__ = ()
+
+class Violation(collections.namedtuple('Violation', ['reason', 'tag', 'name', 'line', 'column'])):
+   """
+   The first thing filtering would change in a document, found by HTMLFilter.validate: the reason (as in a
+   FilterReport, or text_changed, tag_rewritten, tags_not_closed, tag_mismatch or syntax_error), the tag and
+   attribute (or url) it applies to, if any, and its line and column
+   """
+   __slots__ = ()
+
+class _NotClean(Exception):
+   """ Raised while validating a document at the first thing filtering would change: (reason, tag, name, position) """
+   pass
+
+class _NeedMoreInput(Exception):
+   """ Raised while feeding a document when a tag continues past the input buffered so far """
+   pass
+
+class _TagChanged(Exception):
+   """ Raised while validating when an opening tag is found to differ from its output, before the output is built """
+   pass
+
+def _purify_text(value, include_quotes=False):
+   if include_quotes:
+      table = HTML_ESCAPE_QUOTES_TABLE
+      if '"' in value or "'" in value:
+         return _escape_entities(value, table)
+   else:
+      table = HTML_ESCAPE_TABLE
+
+   if '<' in value or '>' in value or '&' in value or ';' in value:
+      return _escape_entities(value, table)
+
+   # nothing to escape
+   return value
+
+def _escape_entities(value, table):
+   # escape everything except entities, which end with a ';'
+   if '&' not in value or ';' not in value:
+      return p2to3translate(value, table)
+
+   chunks = ENTITY_MATCH.split(value)
+   for i in range(0, len(chunks), 2):
+      chunks[i] = p2to3translate(chunks[i], table)
+
+   return ''.join(chunks)
+
+def _purify_url(url, allowed_schemes):
+   """ Purifies a url, where allowed_schemes is a set of lower-case schemes """
+   # encode unsafe characters, leaving %XX escapes as they are
+   if '%' in url:
+      chunks = URL_ENCODING_MATCH.split(url)
+      for i in range(0, len(chunks), 2):
+         chunks[i] = p2to3translate(chunks[i], UNSAFE_URL_TABLE)
+      url = ''.join(chunks)
+   else:
+      url = p2to3translate(url, UNSAFE_URL_TABLE)
+
+   if '//' not in allowed_schemes and url.startswith('//'):
+      return None # disallow protocol-relative URLs (possible XSS vector)
+
+   scheme, colon, rest = url.partition(':')
+   if not colon:
+      scheme = ''
+   elif '/' in scheme or '#' in scheme:
+      return None
+   else:
+      url = rest
+
+   if scheme == '':
+      if url == '':
+         return None
+      else:
+         return url
+   elif scheme.lower() in allowed_schemes:
+      return '%s:%s' % (scheme, url)
+   else:
+      return None
+
+def _purify_color(value):
+   value = value.lower()
+
+   if value in HTML_COLORS or COLOR_MATCH.match(value):
+      return value
+
+   return None
+
+def _purify_int(value):
+   try:
+      return str(int(value))
+   except ValueError:
+      return None
+
+# a pattern for each character set used by a rule, see _char_set_match
+_char_set_matches = {}
+
+def _char_set_match(allowed_chars):
+   """ Returns a function matching strings made up only of allowed_chars, compiled once per character set """
+   match = _char_set_matches.get(allowed_chars)
+   if match is None:
+      if allowed_chars:
+         match = re.compile('[%s]*\\Z' % re.escape(allowed_chars)).match
+      else:
+         match = re.compile('\\Z').match
+
+      if len(_char_set_matches) >= MAX_CHAR_SET_PATTERNS:
+         _char_set_matches.clear()
+      _char_set_matches[allowed_chars] = match
+
+   return match
+
+def _purify_set(value, allowed_chars):
+   if _char_set_match(allowed_chars)(value):
+      return value
+   else:
+      return None
+
+def _purify_regex(value, regex):
+   if regex.match(value):
+      return value
+   else:
+      return None
+
+def _reject(value, attribute_name):
+   return None
+
+class PurifierMemo(object):
+   """
+   Remembers the results of a purifier for recently seen (short) values, shared by every filter.
+   The memo is emptied when it reaches max_entries, and can be turned off by setting max_entries to 0.
+   """
+
+   def __init__(self, purifier, max_entries=MAX_MEMO_ENTRIES, max_length=MAX_MEMO_VALUE_LENGTH):
+      self.purifier = purifier
+      self.max_entries = max_entries
+      self.max_length = max_length
+      self.results = {}
+      self.hits = 0
+      self.misses = 0
+
+   def __call__(self, value):
+      try:
+         result = self.results[value]
+      except KeyError:
+         pass
+      else:
+         self.hits += 1
+         return result
+
+      self.misses += 1
+      result = self.purifier(value)
+
+      if len(value) <= self.max_length and self.max_entries > 0:
+         if len(self.results) >= self.max_entries:
+            self.results.clear()
+         self.results[value] = result
+
+      return result
+
+   def clear(self):
+      self.results.clear()
+      self.hits = 0
+      self.misses = 0
+
+   @property
+   def stats(self):
+      lookups = self.hits + self.misses
+      return {
+         'hits': self.hits,
+         'misses': self.misses,
+         'entries': len(self.results),
+         'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+      }
+
+# colors used in styles are usually a handful of values repeated throughout a document
+COLOR_MEMO = PurifierMemo(_purify_color)
+
+# a url purifier for each set of allowed schemes, see _url_memo
+_url_memos = {}
+
+def _url_memo(allowed_schemes):
+   """
+   Returns the PurifierMemo which purifies urls for the given allowed schemes (compared case-insensitively),
+   shared by every filter with the same schemes, as the same links tend to be repeated across documents
+   """
+   key = tuple(allowed_schemes)
+   memo = _url_memos.get(key)
+   if memo is None:
+      schemes = frozenset(scheme.lower() for scheme in allowed_schemes)
+      def purifier(url):
+         return _purify_url(url, schemes)
+
+      if len(_url_memos) >= MAX_URL_MEMOS:
+         _url_memos.clear()
+
+      memo = _url_memos.setdefault(key, PurifierMemo(purifier, max_length=MAX_URL_MEMO_LENGTH))
+
+   return memo
+
+def _compile_value_rule(rules, allowed_schemes):
+   """
+   Builds a validator(value, attribute_name) for a rule which purifies a single value
+   (a built-in rule string, a regex or a function), or returns None if the rule is
+   a collection of allowed values (i.e. a list or dict)
+   """
+   if rules == "*":
+      # leave the value as-is
+      def validator(value, attribute_name):
+         return value
+   elif isinstance(rules, PATTERN_TYPE):
+      def validator(value, attribute_name):
+         return _purify_regex(value, rules)
+   elif rules == "boolean":
+      def validator(value, attribute_name):
+         if value == "" or (attribute_name is not None and value == attribute_name):
+            return True
+         else:
+            return None
+   elif rules == "url":
+      purify_url = _url_memo(allowed_schemes)
+      def validator(value, attribute_name):
+         return purify_url(value.strip())
+   elif rules == "url|empty":
+      purify_url = _url_memo(allowed_schemes)
+      def validator(value, attribute_name):
+         value = value.strip()
+         if value != '':
+            value = purify_url(value)
+         return value
+   elif rules == "color":
+      def validator(value, attribute_name):
+         return COLOR_MEMO(value)
+   elif rules == "measurement":
+      def validator(value, attribute_name):
+         return _purify_regex(value, MEASUREMENT_MATCH)
+   elif rules == "int":
+      def validator(value, attribute_name):
+         return _purify_int(value)
+   elif isinstance(rules, str) and rules in CHARACTER_SET_RULES:
+      allowed_chars, allow_empty = CHARACTER_SET_RULES[rules]
+      match = _char_set_match(allowed_chars)
+      def validator(value, attribute_name):
+         if value == '':
+            return value if allow_empty else None
+         return value if match(value) else None
+   elif rules == "text":
+      def validator(value, attribute_name):
+         return _purify_text(value, include_quotes=True)
+   elif isinstance(rules, str) and rules.startswith('[') and rules.endswith(']'):
+      match = _char_set_match(rules[1:-1])
+      def validator(value, attribute_name):
+         if value == '':
+            return None
+         return value if match(value) else None
+   elif callable(rules):
+      def validator(value, attribute_name):
+         return rules(value)
+   else:
+      return None
+
+   replacement = None
+   stage = 'purify_value'
+   if isinstance(rules, str):
+      replacement = INVALID_ATTRIBUTE_REPLACEMENTS.get(rules)
+      stage = RULE_STAGES.get(rules, stage)
+
+   def purify(value, attribute_name):
+      if UNICODE_ESCAPE in value:
+         # disallow &# in values (can be used for encoding disallowed characters)
+         return replacement
+
+      value = validator(value, attribute_name)
+      if value is None:
+         return replacement
+
+      return value
+
+   purify.stage = stage
+   return purify
+
+def _compile_membership_rule(rules):
+   allowed_values = rules
+   if isinstance(rules, (list, tuple, dict)):
+      try:
+         allowed_values = frozenset(rules)
+      except TypeError:
+         pass # unhashable values, fall back to comparing against each
+
+   def purify(value, attribute_name):
+      if UNICODE_ESCAPE in value or value not in allowed_values:
+         return None
+      return value
+
+   return purify
+
+def _compile_class_rule(rules):
+   rules = tuple(rules)
+
+   patterns = [rule for rule in rules if isinstance(rule, PATTERN_TYPE)]
+   literals = [rule for rule in rules if not isinstance(rule, PATTERN_TYPE)]
+
+   if any(callable(rule) for rule in literals):
+      # functions can add any value, so each rule is applied in order
+      return _compile_ordered_class_rule(rules)
+
+   try:
+      literals = frozenset(literals)
+   except TypeError:
+      return _compile_ordered_class_rule(rules)
+
+   # one match for all of the patterns
+   match = None
+   if len(patterns) == 1:
+      match = patterns[0].match
+   elif len(patterns) > 1:
+      combined_pattern = _combine_patterns([(regex, None) for regex in patterns])
+      if combined_pattern is not None:
+         match = combined_pattern.match
+      else:
+         def match(candidate):
+            return any(regex.match(candidate) for regex in patterns)
+
+   def purify(value, attribute_name):
+      if UNICODE_ESCAPE in value:
+         return None
+
+      allowed_values_set = set()
+      allowed_values = []
+
+      for candidate in value.split(' '):
+         if candidate and candidate not in allowed_values_set and (
+            candidate in literals or (match is not None and match(candidate))
+         ):
+            allowed_values_set.add(candidate)
+            allowed_values.append(candidate)
+
+      if len(allowed_values) > 0:
+         return ' '.join(allowed_values)
+      else:
+         return None
+
+   purify.stage = 'purify_class'
+   return purify
+
+def _compile_ordered_class_rule(rules):
+   def purify(value, attribute_name):
+      if UNICODE_ESCAPE in value:
+         return None
+
+      candidate_values = value.split(' ')
+      allowed_values_set = set()
+      allowed_values = []
+
+      for candidate in candidate_values:
+         for rule in rules:
+            new_class_value = None
+            if isinstance(rule, PATTERN_TYPE):
+               new_class_value = _purify_regex(candidate, rule)
+            elif callable(rule):
+               new_class_value = rule(value)
+            elif candidate == rule:
+               new_class_value = candidate
+
+            if new_class_value and new_class_value not in allowed_values_set:
+               allowed_values_set.add(new_class_value)
+               allowed_values.append(new_class_value)
+
+      if len(allowed_values) > 0:
+         return ' '.join(allowed_values)
+      else:
+         return None
+
+   purify.stage = 'purify_class'
+   return purify
+
+def _compile_style_properties(rules, allowed_schemes):
+   properties = {}
+   for name, style_rules in rules.items():
+      validator = _compile_value_rule(style_rules, allowed_schemes)
+      if validator is None:
+         validator = _compile_membership_rule(style_rules)
+      properties[name] = validator
+
+   return properties
+
+def _split_declarations(style):
+   """
+   Splits a style attribute into a list of (name, value, is_escaped) in one pass, where is_escaped
+   is True if the declaration contains a CSS unicode escape (a backslash followed by a hex digit).
+   Colons and semicolons are only separators outside of quotes and parentheses, so values such as
+   url(http://example.com/a;b) are kept whole. A final declaration with an unclosed quote or parenthesis is left out.
+   """
+   if '"' not in style and "'" not in style and '\\' not in style:
+      # no semicolons to skip over, unless they're within parentheses
+      declarations = []
+      for declaration in style.split(';'):
+         if '(' in declaration and not FLAT_PARENTHESES_MATCH.match(declaration):
+            break
+
+         name, colon, value = declaration.partition(':')
+         if colon:
+            declarations.append((name, value, False))
+      else:
+         return declarations
+
+   declarations = []
+   start = 0
+   depth = 0
+   quote = None
+   is_escaped = False
+
+   for match in CSS_SPECIAL_MATCH.finditer(style):
+      token = match.group()
+
+      if token[0] == '\\':
+         if token[1:] in HEX_DIGITS:
+            is_escaped = True
+      elif quote is not None:
+         if token == quote:
+            quote = None
+      elif token == '"' or token == "'":
+         quote = token
+      elif token == '(':
+         depth += 1
+      elif token == ')':
+         if depth > 0:
+            depth -= 1
+      elif depth == 0:
+         # end of the declaration
+         _append_declaration(declarations, style, start, match.start(), is_escaped)
+         start = match.end()
+         is_escaped = False
+
+   if quote is None and depth == 0:
+      _append_declaration(declarations, style, start, len(style), is_escaped)
+
+   return declarations
+
+def _append_declaration(declarations, style, start, end, is_escaped):
+   # property names can't contain quotes or parentheses, so the first colon separates the name from the value
+   colon = style.find(':', start, end)
+   if colon != -1:
+      declarations.append((style[start:colon], style[colon + 1:end], is_escaped))
+
+def _purify_declarations(style, properties):
+   # purifies each declaration in a style attribute, returning a list of those allowed
+   allowed_values = []
+   for name, value, is_escaped in _split_declarations(style):
+      if is_escaped:
+         # disallow CSS unicode escaping
+         continue
+
+      name = name.strip()
+      validator = properties.get(name)
+      if validator is None:
+         continue
+
+      value = validator(value.strip(), None)
+      if value is None or value == '':
+         continue
+
+      allowed_values.append(':'.join([name, value]))
+
+   return allowed_values
+
+def _compile_style_rule(rules, allowed_schemes):
+   properties = _compile_style_properties(rules, allowed_schemes)
+
+   def purify(value, attribute_name):
+      if UNICODE_ESCAPE in value:
+         return None
+
+      allowed_values = _purify_declarations(value, properties)
+
+      if len(allowed_values) > 0:
+         return ';'.join(allowed_values) + ';'
+      else:
+         return None
+
+   purify.stage = 'purify_style'
+   return purify
+
+def _describe_rule(rules):
+   """ A short description of an attribute's rules, for reports of what they rejected """
+   if isinstance(rules, str):
+      return rules
+   elif isinstance(rules, PATTERN_TYPE):
+      return '/%s/' % (rules.pattern,)
+   elif isinstance(rules, list):
+      return 'list'
+   elif isinstance(rules, dict):
+      return 'dict'
+   elif callable(rules):
+      return getattr(rules, '__name__', 'function')
+   else:
+      return repr(rules)
+
+def _compile_rule(rules, attribute_name, allowed_schemes):
+   """
+   Builds a validator(value, attribute_name) for an attribute's rules, returning the purified value,
+   True for a present boolean attribute, or None to remove the attribute.
+   attribute_name is None if the rules apply to attribute names only known while filtering
+   """
+   if rules is None:
+      return _reject
+
+   validator = _build_rule(rules, attribute_name, allowed_schemes)
+   validator.rule = _describe_rule(rules)
+   return validator
+
+def _build_rule(rules, attribute_name, allowed_schemes):
+
+   validator = _compile_value_rule(rules, allowed_schemes)
+   if validator is not None:
+      return validator
+
+   membership_validator = _compile_membership_rule(rules)
+
+   if isinstance(rules, list):
+      if attribute_name == 'class':
+         return _compile_class_rule(rules)
+      elif attribute_name is None:
+         class_validator = _compile_class_rule(rules)
+         def validator(value, attribute_name):
+            if attribute_name == 'class':
+               return class_validator(value, attribute_name)
+            return membership_validator(value, attribute_name)
+         return validator
+   elif isinstance(rules, dict):
+      if attribute_name == 'style':
+         return _compile_style_rule(rules, allowed_schemes)
+      elif attribute_name is None:
+         style_validator = _compile_style_rule(rules, allowed_schemes)
+         def validator(value, attribute_name):
+            if attribute_name == 'style':
+               return style_validator(value, attribute_name)
+            return membership_validator(value, attribute_name)
+         return validator
+
+   return membership_validator
+
+def _resolve_alias(spec, tag_name):
+   alias_attributes = []
+   seen = set()
+   while tag_name in spec and isinstance(spec[tag_name], str):
+      if tag_name in seen:
+         raise ValueError('Tag aliases form a loop: <%s>' % (tag_name,))
+      seen.add(tag_name)
+
+      tag_parts = spec[tag_name].split(' ') # follow aliases
+      tag_name = tag_parts[0]
+      if len(tag_parts) > 1:
+         alias_attributes += tag_parts[1:]
+
+   return tag_name, tuple(alias_attributes)
+
+def _combine_patterns(patterns):
+   """
+   Folds a list of (regex, rule) into one regex with a named group for each pattern, so that
+   a single match finds the first pattern which matches. Returns None if they can't be combined.
+   """
+   if len(patterns) < 2:
+      return None
+
+   flags = set(regex.flags for regex, _ in patterns)
+   if len(flags) != 1:
+      return None
+
+   flags = flags.pop()
+   if flags & re.VERBOSE:
+      return None
+
+   for regex, _ in patterns:
+      if not isinstance(regex.pattern, str) or regex.groupindex or UNCOMBINABLE_PATTERN_MATCH.search(regex.pattern):
+         return None
+
+   try:
+      return re.compile('|'.join(
+         '(?P<rule%d>%s)' % (i, regex.pattern) for i, (regex, _) in enumerate(patterns)
+      ), flags)
+   except re.error:
+      return None
+
+class _CompiledTag(object):
+   """ The attribute rules of a single tag, with each rule built into a validator """
+   __slots__ = ('attributes', 'wildcard', 'patterns', 'booleans', 'combined_pattern', 'pattern_rules')
+
+   def __init__(self, tag_spec, allowed_schemes):
+      self.attributes = {}
+      self.wildcard = None
+      self.booleans = set()
+
+      patterns = []
+      pattern_pairs = None
+      for attribute_name, rules in tag_spec.items():
+         if isinstance(attribute_name, PATTERN_TYPE):
+            patterns.append((attribute_name, _compile_rule(rules, None, allowed_schemes)))
+         elif attribute_name == '*':
+            self.wildcard = _compile_rule(rules, None, allowed_schemes)
+         elif attribute_name == '^$':
+            # [RegEx, rule] pairs, evaluated in order
+            pattern_pairs = [
+               (regex, _compile_rule(pair_rules, None, allowed_schemes))
+               for regex, pair_rules in rules
+               if isinstance(regex, PATTERN_TYPE)
+            ]
+         else:
+            self.attributes[attribute_name] = _compile_rule(rules, attribute_name, allowed_schemes)
+            if rules == "boolean":
+               self.booleans.add(attribute_name)
+
+      # regex keys are only consulted when there are no "^$" pairs
+      if pattern_pairs is not None:
+         patterns = pattern_pairs
+
+      self.patterns = tuple(patterns)
+      self.booleans = frozenset(self.booleans)
+
+      self.combined_pattern = _combine_patterns(self.patterns)
+      self.pattern_rules = {} # attribute name -> pattern rule (or None), for names matched so far
+
+   def get_rule(self, attribute_name):
+      rule = self.attributes.get(attribute_name)
+      if rule is None:
+         rule = self.wildcard
+      if rule is None and self.patterns:
+         try:
+            return self.pattern_rules[attribute_name]
+         except KeyError:
+            pass
+
+         rule = self.__match_patterns(attribute_name)
+
+         if len(self.pattern_rules) >= MAX_PATTERN_RULES:
+            self.pattern_rules.clear()
+         self.pattern_rules[attribute_name] = rule
+
+      return rule
+
+   def __match_patterns(self, attribute_name):
+      if self.combined_pattern is not None:
+         match = self.combined_pattern.match(attribute_name)
+         if match is None:
+            return None
+
+         # the outermost group of the matching pattern is the last to close
+         return self.patterns[int(match.lastgroup[len('rule'):])][1]
+
+      for regex, pattern_rule in self.patterns:
+         if regex.match(attribute_name):
+            return pattern_rule
+
+      return None
+
+_EMPTY_TAG = _CompiledTag({}, DEFAULT_SCHEMES)
+
+class CompiledSpec(object):
+   """
+   An immutable, pre-processed whitelist specification: aliases are resolved, and
+   rules are built into validators. Build one with compile_spec(), and pass it in place
+   of the spec dictionary to share it between HTMLFilter instances.
+   """
+   __slots__ = ('spec', 'allowed_schemes', 'tags', 'aliases', 'global_attrs', 'is_script_escaped', 'pure_tags', 'has_pure_delegates',
+      'has_tag_functions', '_delegate_results', '_delegate_shapes')
+
+   def __init__(self, spec, allowed_schemes=DEFAULT_SCHEMES):
+      tags = {}
+      aliases = {}
+      for tag_name, tag_spec in spec.items():
+         if tag_name == '*':
+            continue
+         if isinstance(tag_spec, dict):
+            tags[tag_name] = _CompiledTag(tag_spec, allowed_schemes)
+         else:
+            tags[tag_name] = tag_spec
+            if isinstance(tag_spec, str):
+               aliases[tag_name] = _resolve_alias(spec, tag_name)
+
+      # allow global attributes
+      global_attrs = {}
+      if isinstance(spec.get('*'), dict):
+         for attribute_name, rules in spec['*'].items():
+            global_attrs[attribute_name] = _compile_rule(rules, attribute_name, allowed_schemes)
+
+      initialize = super(CompiledSpec, self).__setattr__
+      initialize('spec', spec)
+      initialize('allowed_schemes', allowed_schemes)
+      initialize('tags', tags)
+      initialize('aliases', aliases)
+      initialize('global_attrs', global_attrs)
+      initialize('is_script_escaped', 'script' in spec and isinstance(spec['script'], str))
+      # tags whose filtering functions are pure when the spec is compiled (marking one pure later has no effect)
+      pure_tags = frozenset(tag_name for tag_name, tag_spec in tags.items() if callable(tag_spec) and getattr(tag_spec, 'pure', False))
+      initialize('pure_tags', pure_tags)
+      initialize('has_pure_delegates', len(pure_tags) > 0)
+      initialize('has_tag_functions', any(callable(tag_spec) for tag_spec in tags.values()))
+      initialize('_delegate_results', {})
+      initialize('_delegate_shapes', {})
+
+   def __setattr__(self, name, value):
+      raise AttributeError('CompiledSpec is immutable')
+
+   def __delattr__(self, name):
+      raise AttributeError('CompiledSpec is immutable')
+
+   def __reduce__(self):
+      # validators are closures, so rebuild them from the original spec when unpickling
+      return (compile_spec, (self.spec, self.allowed_schemes))
+
+   def compile_tag(self, tag_spec):
+      """
+      Compiles a tag spec returned by a tag filtering function. Dictionaries are compiled
+      once per object, so a function should not modify a dictionary it has already returned,
+      and once per shape, so a function can return a new dictionary with the same rules each time.
+      """
+      if not isinstance(tag_spec, dict):
+         return tag_spec
+
+      key = id(tag_spec)
+      cached = self._delegate_results.get(key)
+      if cached is not None and cached[0] is tag_spec:
+         return cached[1]
+
+      shape = _spec_shape(tag_spec)
+      compiled_tag = self._delegate_shapes.get(shape) if shape is not None else None
+      if compiled_tag is None:
+         compiled_tag = _CompiledTag(tag_spec, self.allowed_schemes)
+         if shape is not None:
+            if len(self._delegate_shapes) >= MAX_DELEGATE_RESULTS:
+               self._delegate_shapes.clear()
+            self._delegate_shapes[shape] = compiled_tag
+
+      if len(self._delegate_results) >= MAX_DELEGATE_RESULTS:
+         self._delegate_results.clear()
+
+      # keep a reference to the dictionary so its id can't be re-used
+      self._delegate_results[key] = (tag_spec, compiled_tag)
+      return compiled_tag
+
+def _spec_shape(value):
+   """
+   Returns a hashable key for a tag spec, equal for specs with the same rules (in the same order),
+   or None if it holds something which can't be hashed
+   """
+   if isinstance(value, dict):
+      shape = ['{']
+      for key, item in value.items():
+         # most keys and rules are strings, which are their own shape
+         if type(item) is not str:
+            item = _spec_shape(item)
+            if item is None:
+               return None
+         shape.append(key if type(key) is str else _spec_shape(key))
+         shape.append(item)
+      return tuple(shape)
+   elif isinstance(value, (list, tuple)):
+      shape = ['[']
+      for item in value:
+         if type(item) is not str:
+            item = _spec_shape(item)
+            if item is None:
+               return None
+         shape.append(item)
+      return tuple(shape)
+   elif isinstance(value, str):
+      return value
+
+   try:
+      hash(value)
+   except TypeError:
+      return None
+
+   # e.g. True and 1 are equal, but aren't the same rule
+   return (type(value), value)
+
+# the CompiledSpec of each spec dictionary given to HTMLFilter, see _compiled_spec_of
+_compiled_specs = {}
+
+def _spec_snapshot(value):
+   # a copy of the dictionaries, lists and tuples in a spec (sharing everything else), to tell whether it has been modified
+   if isinstance(value, dict):
+      return dict((key, _spec_snapshot(item)) for key, item in value.items())
+   elif isinstance(value, list):
+      return [_spec_snapshot(item) for item in value]
+   elif isinstance(value, tuple):
+      return tuple(_spec_snapshot(item) for item in value)
+
+   return value
+
+def _compiled_spec_of(spec, allowed_schemes):
+   """
+   Returns a CompiledSpec of a spec dictionary, compiled once while the dictionary is unchanged, so
+   filter_html(html, spec) and new HTMLFilters for the same spec don't compile it again each time
+   """
+   key = (id(spec), tuple(allowed_schemes))
+   # tag filtering functions can be marked pure after they're added to the spec, so compile it again if they are
+   pure_tags = frozenset(tag_name for tag_name, tag_spec in spec.items()
+      if tag_name != '*' and callable(tag_spec) and getattr(tag_spec, 'pure', False))
+
+   cached = _compiled_specs.get(key)
+   if cached is not None and cached[0] is spec and cached[1] == spec and cached[2].pure_tags == pure_tags:
+      return cached[2]
+
+   compiled_spec = compile_spec(spec, allowed_schemes=allowed_schemes)
+   if len(_compiled_specs) >= MAX_COMPILED_SPECS:
+      _compiled_specs.clear()
+
+   # keep a reference to the dictionary so its id can't be re-used, and a snapshot to compare it with
+   _compiled_specs[key] = (spec, _spec_snapshot(spec), compiled_spec)
+   return compiled_spec
+
+def _fingerprint_parts(value, parts):
+   # appends a canonical description of value to parts, returning False if it can't be described
+   if isinstance(value, dict):
+      items = []
+      for key, item in value.items():
+         key_parts = []
+         if not _fingerprint_parts(key, key_parts):
+            return False
+         items.append((''.join(key_parts), item))
+
+      parts.append('{')
+      for key, item in sorted(items, key=lambda pair: pair[0]):
+         parts.append(key)
+         parts.append(':')
+         if not _fingerprint_parts(item, parts):
+            return False
+         parts.append(',')
+      parts.append('}')
+   elif isinstance(value, (list, tuple)):
+      parts.append('[')
+      for item in value:
+         if not _fingerprint_parts(item, parts):
+            return False
+         parts.append(',')
+      parts.append(']')
+   elif isinstance(value, PATTERN_TYPE):
+      parts.append('re(%r,%d)' % (value.pattern, value.flags))
+   elif value is None or isinstance(value, (bool, int, float, str)):
+      parts.append(repr(value))
+   elif callable(value):
+      # functions can only be fingerprinted if they declare one
+      fingerprint = getattr(value, 'fingerprint', None)
+      if fingerprint is None:
+         return False
+      parts.append('fn(%r)' % (fingerprint,))
+   else:
+      return False
+
+   return True
+
+def spec_fingerprint(spec, allowed_schemes=DEFAULT_SCHEMES, remove=None, text_filter=None, repair=False, limits=None):
+   """
+   Returns a stable hash of a whitelist specification and filtering options, or None if it
+   contains functions (e.g. tag spec functions, delegates or a text_filter) which don't
+   declare a fingerprint attribute, as their output can't be known in advance.
+   """
+   if isinstance(spec, CompiledSpec):
+      spec = spec.spec
+
+   options = [spec, list(allowed_schemes), remove, text_filter]
+   if repair:
+      # repaired documents would raise TagMismatchError without repair
+      options.append('repair')
+
+   if limits is not None:
+      # documents over these limits raise LimitExceededError, so output can't be shared with filters without
+      # them. max_input is checked before looking in the cache, and time_limit only bounds the time spent
+      limit_values = [limits.max_depth, limits.max_attributes, limits.max_value_length, limits.max_text_expansion]
+      if any(value is not None for value in limit_values):
+         options.append(limit_values)
+
+   parts = []
+   if not _fingerprint_parts(options, parts):
+      return None
+
+   return hashlib.sha256(''.join(parts).encode('utf-8')).hexdigest()
+
+class MemoryCache(object):
+   """ An in-memory LRU cache backend, bounded by number of entries and (optionally) total characters """
+   def __init__(self, max_entries=1024, max_size=None):
+      self.max_entries = max_entries
+      self.max_size = max_size
+      self.size = 0
+      self.entries = collections.OrderedDict()
+      self.lock = threading.Lock()
+
+   def get(self, key):
+      with self.lock:
+         value = self.entries.pop(key, None)
+         if value is not None:
+            # most recently used entries are kept at the end
+            self.entries[key] = value
+         return value
+
+   def set(self, key, value):
+      if self.max_size is not None and len(value) > self.max_size:
+         return
+
+      with self.lock:
+         previous = self.entries.pop(key, None)
+         if previous is not None:
+            self.size -= len(previous)
+
+         self.entries[key] = value
+         self.size += len(value)
+
+         while len(self.entries) > self.max_entries or (self.max_size is not None and self.size > self.max_size):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+   def clear(self):
+      with self.lock:
+         self.entries.clear()
+         self.size = 0
+
+class FileCache(object):
+   """ A cache backend storing one file per entry in a directory, evicting the least recently used """
+   def __init__(self, directory, max_entries=100000):
+      self.directory = directory
+      self.max_entries = max_entries
+
+      if not os.path.isdir(directory):
+         os.makedirs(directory)
+
+      self.num_entries = len(os.listdir(directory))
+
+   def __path(self, key):
+      return os.path.join(self.directory, key)
+
+   def get(self, key):
+      try:
+         with io.open(self.__path(key), 'r', encoding='utf-8', newline='') as cache_file:
+            value = cache_file.read()
+      except (IOError, OSError):
+         return None
+
+      try:
+         os.utime(self.__path(key), None)
+      except OSError:
+         pass # evicted by another process
+
+      return value
+
+   def set(self, key, value):
+      path = self.__path(key)
+      temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+      with io.open(temp_path, 'w', encoding='utf-8', newline='') as cache_file:
+         cache_file.write(value)
+      os.rename(temp_path, path)
+
+      self.num_entries += 1
+      if self.num_entries > self.max_entries:
+         self.__evict()
+
+   def __evict(self):
+      # remove the least recently used tenth of the entries
+      paths = [self.__path(name) for name in os.listdir(self.directory)]
+      entries = []
+      for path in paths:
+         try:
+            entries.append((os.path.getmtime(path), path))
+         except OSError:
+            pass
+
+      entries.sort()
+      num_evicted = max(len(entries) - self.max_entries * 9 // 10, 0)
+      for _, path in entries[:num_evicted]:
+         try:
+            os.remove(path)
+         except OSError:
+            pass
+
+      self.num_entries = len(entries) - num_evicted
+
+   def clear(self):
+      for name in os.listdir(self.directory):
+         os.remove(self.__path(name))
+      self.num_entries = 0
+
+class FilterCache(object):
+   """
+   Caches filtered output by spec fingerprint and input hash, counting hits and misses.
+   The backend is any object with get(key) and set(key, value) methods (MemoryCache by default).
+   """
+   def __init__(self, backend=None):
+      if backend is None:
+         backend = MemoryCache()
+
+      self.backend = backend
+      self.hits = 0
+      self.misses = 0
+      self.skipped = 0
+
+   def key(self, fingerprint, html):
+      digest = hashlib.sha256(html.encode('utf-8', 'surrogatepass')).hexdigest()
+      return '%s-%s' % (fingerprint[:32], digest)
+
+   def get(self, key):
+      value = self.backend.get(key)
+      if value is None:
+         self.misses += 1
+      else:
+         self.hits += 1
+      return value
+
+   def set(self, key, value):
+      self.backend.set(key, value)
+
+   @property
+   def stats(self):
+      lookups = self.hits + self.misses
+      return {
+         'hits': self.hits,
+         'misses': self.misses,
+         'skipped': self.skipped,
+         'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+      }
+
+class FilterStats(object):
+   """
+   Counters, and cumulative timings in seconds, collected by an HTMLFilter created with stats=FilterStats().
+   Rules are timed by stage: purify_url, purify_color, purify_text, purify_class, purify_style (including
+   the rules of each property) and purify_value (any other rule). filter_text is the time spent escaping
+   or filtering runs of text, including the text_filter, which is also timed on its own. tag_spec is the
+   time spent in tag filtering functions, and process is the total time spent filtering. Documents returned
+   from a cache count towards input_chars, output_chars and cache_hits, but aren't filtered, so nothing else.
+   """
+   def __init__(self):
+      self.reset()
+
+   def reset(self):
+      self.input_chars = 0
+      self.output_chars = 0
+      self.cache_hits = 0
+      self.tags = 0
+      self.tags_dropped = 0
+      self.attributes = 0
+      self.attributes_dropped = collections.Counter() # by reason: not_allowed, invalid_value, no_value or malformed
+      self.timings = collections.defaultdict(float)
+      self.calls = collections.Counter()
+
+   def timed(self, stage, function, *args):
+      start = TIMER()
+      try:
+         return function(*args)
+      finally:
+         self.add_time(stage, TIMER() - start)
+
+   def add_time(self, stage, seconds):
+      self.timings[stage] += seconds
+      self.calls[stage] += 1
+
+   def record(self, kind, name, reason):
+      # a tag or attribute, and the reason it was dropped (or None if it was kept)
+      if kind == 'tag':
+         self.tags += 1
+         if reason is not None:
+            self.tags_dropped += 1
+      elif kind == 'attribute':
+         self.attributes += 1
+         if reason is not None:
+            self.attributes_dropped[reason] += 1
+
+   def as_dict(self):
+      return {
+         'input_chars': self.input_chars,
+         'output_chars': self.output_chars,
+         'cache_hits': self.cache_hits,
+         'tags': self.tags,
+         'tags_dropped': self.tags_dropped,
+         'attributes': self.attributes,
+         'attributes_dropped': dict(self.attributes_dropped),
+         'timings': dict(self.timings),
+         'calls': dict(self.calls),
+      }
+
+class FilterLimits(object):
+   """
+   Bounds on the work an HTMLFilter does for one document, each None for no limit: max_input characters,
+   max_depth of nested elements, max_attributes on a tag, max_value_length of an attribute value,
+   max_text_expansion of a run of text by the text_filter (as a multiple of its length), and a time_limit in
+   seconds spent filtering the document (not counting time between chunks fed to it). Tags in the output of a
+   text_filter are within the same limits. A document over a limit raises LimitExceededError.
+   """
+   def __init__(self, max_input=None, max_depth=None, max_attributes=None, max_value_length=None,
+         max_text_expansion=None, time_limit=None):
+      self.max_input = max_input
+      self.max_depth = max_depth
+      self.max_attributes = max_attributes
+      self.max_value_length = max_value_length
+      self.max_text_expansion = max_text_expansion
+      self.time_limit = time_limit
+
+class ReportEvent(collections.namedtuple('ReportEvent', ['kind', 'tag', 'name', 'reason', 'rule', 'line', 'column'])):
+   """
+   One thing a filter removed or changed: a dropped tag, a dropped attribute, a rewritten url, a removed
+   tag (along with its contents), or a repair, at the line and column of the tag it was found in
+   """
+   __slots__ = ()
+
+class FilterReport(object):
+   """
+   What an HTMLFilter created with report=FilterReport() removed or changed, and why. Counters are always kept:
+   tags_dropped and tags_removed (whose contents were removed too) by tag name, attributes_dropped by
+   (tag, attribute, reason, rule), where the reason is not_allowed, invalid_value, no_value or malformed,
+   urls_rewritten by (tag, attribute), and, when filtering with repair=True, repairs by (tag, reason), where
+   the reason is closed_implicitly, dropped_closing_tag or closed_at_end. With events=True, a ReportEvent
+   is also kept for each one.
+   """
+   def __init__(self, events=False):
+      self.keep_events = events
+      self.reset()
+
+   def reset(self):
+      self.tags_dropped = collections.Counter()
+      self.tags_removed = collections.Counter()
+      self.attributes_dropped = collections.Counter()
+      self.urls_rewritten = collections.Counter()
+      self.repairs = collections.Counter()
+      self.events = [] if self.keep_events else None
+
+   def record(self, kind, tag_name, name, reason, rule, location):
+      # a tag, attribute or url, and the reason it was changed or dropped (or None if it was kept as it is)
+      if reason is None:
+         return
+
+      if kind == 'tag':
+         if reason == 'removed':
+            self.tags_removed[name] += 1
+         else:
+            self.tags_dropped[name] += 1
+      elif kind == 'attribute':
+         self.attributes_dropped[(tag_name, name, reason, rule)] += 1
+      elif kind == 'repair':
+         self.repairs[(tag_name, reason)] += 1
+      else:
+         self.urls_rewritten[(tag_name, name)] += 1
+
+      if self.events is not None:
+         self.events.append(ReportEvent(kind, tag_name, name, reason, rule, location[0], location[1]))
+
+   def as_dict(self):
+      report = {
+         'tags_dropped': dict(self.tags_dropped),
+         'tags_removed': dict(self.tags_removed),
+         'attributes_dropped': dict(self.attributes_dropped),
+         'urls_rewritten': dict(self.urls_rewritten),
+         'repairs': dict(self.repairs),
+      }
+      if self.events is not None:
+         report['events'] = [event._asdict() for event in self.events]
+      return report
+
 class HTMLFilter(object):
-   def __init__(self, spec, allowed_schemes=('http', 'https', 'mailto', 'ftp'), text_filter=None, remove=None):
-      self.tag_chars = TAG_CHARS
+   def __init__(self, spec, allowed_schemes=None, text_filter=None, remove=None, cache=None, stats=None, report=None,
+         limits=None, repair=False):
+      if isinstance(spec, CompiledSpec):
+         if allowed_schemes is not None and allowed_schemes != spec.allowed_schemes:
+            raise ValueError('allowed_schemes must be given to compile_spec when using a CompiledSpec')
+      else:
+         if allowed_schemes is None:
+            allowed_schemes = DEFAULT_SCHEMES
+         spec = _compiled_spec_of(spec, allowed_schemes)
+
       self.attr_chars = ATTR_CHARS
-      self.trans_table = TRANS_TABLE
-      self.tag_removing = None
       self.removals = remove
 
+      self.compiled_spec = spec
+      self.spec = spec.spec
+
       if self.removals is None:
          # by default scripts and styles are removed if they don't exist in the spec
          self.removals = []
-         if 'script' not in spec:
+         if 'script' not in self.spec:
             self.removals.append('script')
-         if 'style' not in spec:
+         if 'style' not in self.spec:
             self.removals.append('style')
 
       self.remove_scripts = ('script' in self.removals)
 
-      self.allowed_schemes = allowed_schemes
+      self.allowed_schemes = spec.allowed_schemes
+      self.url_memo = _url_memo(self.allowed_schemes)
+
+      # the compiled properties of each style rules dictionary given to purify_style
+      self.style_properties = {}
 
       self.text_filter = text_filter
 
+      # text filter output is re-filtered by a filter sharing this one's compiled spec, created when first needed
+      self.text_html_filter = None
+
+      # filters documents for afilter, created when first needed
+      self.async_filter = None
+
+      # a FilterStats to collect counters and timings in, and a FilterReport of what was removed, if any
+      self.stats = stats
+      self.report = report
+      self.is_recording = stats is not None or report is not None
+
+      # FilterLimits on the work done for each document, if any
+      self.limits = limits
+
+      # whether mismatched tags are repaired, instead of raising TagMismatchError
+      self.repair = repair
+
+      # output is only cached when everything which affects it can be fingerprinted
+      self.cache = cache
+      self.cache_fingerprint = None
+      if cache is not None:
+         self.cache_fingerprint = spec_fingerprint(self.spec, self.allowed_schemes, self.removals, text_filter, repair, limits)
+
+      # the document each thread is feeding, if any
+      self.local = threading.local()
+
+   def filter(self, html):
+      if self.limits is not None and self.limits.max_input is not None and len(html) > self.limits.max_input:
+         _ParseContext(self).check_input(html)
+
+      if self.cache is None:
+         return self.__filter(html)
+
+      if self.cache_fingerprint is None:
+         self.cache.skipped += 1
+         return self.__filter(html)
+
+      key = self.cache.key(self.cache_fingerprint, html)
+      filtered_html = self.cache.get(key)
+      if filtered_html is None:
+         filtered_html = self.__filter(html)
+         self.cache.set(key, filtered_html)
+      elif self.stats is not None:
+         self.stats.cache_hits += 1
+         self.stats.input_chars += len(html)
+         self.stats.output_chars += len(filtered_html)
+
+      return filtered_html
+
+   def __filter(self, html):
+      return _ParseContext(self).filter(html)
+
+   def filter_to(self, html, writer):
+      """
+      Filters a document, writing the output to writer (e.g. a file) in pieces, instead of returning it.
+      If the document is invalid, the output up to the error will already have been written.
+      """
+      if self.cache is not None:
+         writer.write(self.filter(html))
+         return
+
+      _ParseContext(self).filter_to(html, writer)
+
+   def feed(self, chunk):
+      """
+      Filters the next chunk of a document, returning the filtered output which is safe to emit so far.
+      Output for a tag (or a run of text, when using a text_filter) is held back until it is complete.
+      Each thread feeds a document of its own.
+      """
+      context = getattr(self.local, 'feeding', None)
+      if context is None:
+         context = self.local.feeding = _ParseContext(self)
+
+      return context.feed(chunk)
+
+   def close(self):
+      """ Finishes the document being fed, returning the remaining filtered output """
+      context = getattr(self.local, 'feeding', None)
+      self.local.feeding = None
+      if context is None:
+         context = _ParseContext(self)
+
+      return context.close()
+
+   def filter_iter(self, chunks):
+      """ Filters an iterable of chunks of a document, yielding filtered output as it becomes available """
+      context = _ParseContext(self)
+      for chunk in chunks:
+         output = context.feed(chunk)
+         if output:
+            yield output
+
+      output = context.close()
+      if output:
+         yield output
+
+   def validate(self, html):
+      """
+      Checks whether a document is already clean (filtering it would leave it unchanged) without building the
+      output, stopping at the first difference. Returns None if it is clean, otherwise a Violation.
+      """
+      return _ParseContext(self).validate(html)
+
+   def is_clean(self, html):
+      """ Whether filtering a document would leave it unchanged, see validate """
+      return self.validate(html) is None
+
+   def filter_bytes(self, data, encoding='utf-8', errors='strict'):
+      """
+      Filters an encoded document (bytes, a bytearray or a memoryview), returning the filtered document
+      encoded the same way. Invalid input raises UnicodeDecodeError, unless errors says otherwise
+      (e.g. 'surrogateescape' passes invalid bytes through to the output unchanged).
+      """
+      return self.filter(codecs.decode(data, encoding, errors)).encode(encoding, errors)
+
+   def filter_bytes_iter(self, chunks, encoding='utf-8', errors='strict'):
+      """ Filters an iterable of encoded chunks of a document, yielding encoded output as it becomes available """
+      for output in self.filter_iter(_decode_chunks(chunks, encoding, errors)):
+         yield output.encode(encoding, errors)
+
+   def afilter(self, html, timeout=None):
+      """
+      Returns an awaitable of the filtered document, filtered on the executor shared by filter_html_async
+      (or straight away, if it is short). See AsyncFilter.
+      """
+      if self.async_filter is None:
+         self.async_filter = AsyncFilter(self.compiled_spec, executor=_shared_executor(),
+            text_filter=self.text_filter, remove=self.removals, cache=self.cache, stats=self.stats, report=self.report,
+            limits=self.limits, repair=self.repair)
+
+      return self.async_filter.filter(html, timeout=timeout)
+
+   def filter_batch(self, documents, workers=None, chunksize=BATCH_CHUNKSIZE):
+      """
+      Filters an iterable of documents, yielding a FilterResult for each, in order.
+      See filter_many for running the batch on a pool of worker processes.
+      """
+      if workers is not None and workers > 1:
+         return filter_many(documents, self.compiled_spec, workers=workers, chunksize=chunksize,
+            text_filter=self.text_filter, remove=self.removals, limits=self.limits, repair=self.repair)
+
+      return (self.__filter_result(html) for html in documents)
+
+   def __filter_result(self, html):
+      try:
+         return FilterResult(self.filter(html), None)
+      except (TagMismatchError, HTMLSyntaxError, LimitExceededError) as error:
+         return FilterResult(None, error)
+
+   def purify_value(self, value, rules, attribute_name=None):
+      """
+      Purifies a value with a single-value rule, returning (value, True),
+      or (value, False) if the rules are a collection of allowed values
+      """
+      validator = _compile_value_rule(rules, self.allowed_schemes)
+      if validator is None:
+         return value, False
+
+      return validator(value, attribute_name), True
+
+   def purify_style(self, style, rules):
+      """
+      Purifies the declarations of a style attribute, returning those allowed by rules, or None.
+      The rules are compiled once per dictionary, so don't modify them after passing them in.
+      """
+      assert isinstance(rules, dict)
+
+      key = id(rules)
+      cached = self.style_properties.get(key)
+      if cached is not None and cached[0] is rules:
+         properties = cached[1]
+      else:
+         properties = _compile_style_properties(rules, self.allowed_schemes)
+         if len(self.style_properties) >= MAX_STYLE_PROPERTIES:
+            self.style_properties.clear()
+
+         # keep a reference to the dictionary so its id can't be re-used
+         self.style_properties[key] = (rules, properties)
+
+      allowed_values = _purify_declarations(style, properties)
+      if len(allowed_values) > 0:
+         return ';'.join(allowed_values)
+      else:
+         return None
+
+   def purify_color(self, value):
+      return COLOR_MEMO(value)
+
+   def purify_url(self, url):
+      return self.url_memo(url)
+
+   def purify_int(self, value):
+      return _purify_int(value)
+
+   def purify_set(self, value, allowed_chars):
+      return _purify_set(value, allowed_chars)
+
+   def purify_regex(self, value, regex):
+      return _purify_regex(value, regex)
+
+   def purify_text(self, value, include_quotes=False):
+      return _purify_text(value, include_quotes)
+
+class _ParseContext(object):
+   """
+   The state of filtering one document. An HTMLFilter only holds its configuration, and filters each
+   document with a new context, so one filter can be shared by many threads.
+   """
+   def __init__(self, html_filter):
+      # the filter's configuration
+      self.html_filter = html_filter
+      self.compiled_spec = html_filter.compiled_spec
+      self.removals = html_filter.removals
+      self.remove_scripts = html_filter.remove_scripts
+      self.attr_chars = html_filter.attr_chars
+      self.text_filter = html_filter.text_filter
+      self.purify_text = html_filter.purify_text
+      self.stats = html_filter.stats
+      self.report = html_filter.report
+      self.is_recording = html_filter.is_recording
+      self.limits = html_filter.limits
+      self.repair = html_filter.repair
+
+      self.deadline = None
+      self.time_left = None # when feeding, the time limit left for the chunks to come
+      if self.limits is not None and self.limits.time_limit is not None:
+         self.deadline = TIMER() + self.limits.time_limit
+         self.time_left = self.limits.time_limit
+
+      # how deep the document is nested, when it is the output of a text filter inside another document
+      self.outer_depth = 0
+
+      # state for filtering the document
       self.html = ''
+      self.pos = 0
+      self.offset = 0
+      self.lines = 0 # lines before the start of the buffer
+      self.line_start = 0 # where the line the buffer starts on starts, in the whole input
+      self.line_cursor = (0, 0, 0) # a position in the buffer, the lines before it and where its line starts
+      self.text_parts = []
       self.filtered_html = []
+      self.tag_stack = []
+      self.tag_specs = [] # the resolved spec of each element in tag_stack
+      self.tag_spec_memo = {}
+
+      # when repairing, how many elements of each name are open, to find stray closing tags without searching tag_stack
+      self.open_tags = collections.Counter() if self.repair else None
+
+      # with pure tag filtering functions, an id for the names of the elements in tag_stack (and each
+      # element it is inside), so results can be memoized without building a key from the whole stack
+      self.tag_paths = None
+      self.path_ids = None
+      if self.compiled_spec.has_pure_delegates:
+         self.tag_paths = [0]
+         self.path_ids = {}
       self.state = 'data'
+      self.tag_removing = None
+      self.waiting_for = None
+      self.pending_chunks = []
+      self.pending_size = 0
+      self.retry_size = 0 # how much input must arrive before a tag which was re-read is read again
+      self.held_parts = 0 # how many of text_parts are held back as the start of a possible entity
+      self.held_tag_text = None # the filtered text before a tag which is waiting for more input
+      self.is_validating = False # comparing output with the input, instead of collecting it
+      self.clean_tags = None # when validating, what each tag already found clean does to the element stack
+      self.writer = None
+      self.tag_start = 0
+      self.input_size = 0
+      self.pending_records = [] # (kind, tag name, name, reason, rule) for stats and reports, kept until the tag is complete
 
-      # allow global attributes
-      if '*' in spec:
-         self.global_attrs = spec['*']
-      else:
-         self.global_attrs = []
+   def filter(self, html):
+      self.html = html
+      if self.stats is not None:
+         self.stats.input_chars += len(html)
 
-      self.spec = spec
+      self.__process(final=True)
+      self.__check_closed()
 
+      return self.__drain()
+
+   def validate(self, html):
+      if self.limits is not None and self.limits.max_input is not None:
+         self.check_input(html)
 
-   def filter(self, html):
       self.html = html
-      self.chars = self.__char_gen()
-      self.filtered_html = []
-      self.tag_stack = []
+      self.is_validating = True
+      self.is_recording = False # a tag which isn't clean is filtered again with recording on, to find the reason
+      if not self.compiled_spec.has_tag_functions:
+         # otherwise the same tag can be filtered differently depending on the elements it's in
+         self.clean_tags = {}
 
-      is_script_processed = not self.remove_scripts
-      is_script_escaped = 'script' in self.spec and isinstance(self.spec['script'], str)
+      try:
+         self.__process(final=True)
+         if self.tag_stack:
+            raise _NotClean('tags_not_closed', self.tag_stack[-1][0], None, len(html))
+      except _NotClean as not_clean:
+         reason, tag_name, name, pos = not_clean.args
+         return Violation(reason, tag_name, name, *self.__location(pos))
+      except TagMismatchError:
+         return Violation('tag_mismatch', None, None, *self.__location(self.tag_start))
+      except HTMLSyntaxError:
+         return Violation('syntax_error', None, None, *self.__location(self.tag_start))
 
-      text_chars = []
-      while self.__next():
-         if self.curr_char == '<':
-            # opening tag symbol
+      return None
 
-            # collect tag text so far
-            if self.state == 'script-data' and not is_script_escaped:
-               # un-modified
-               tag_text = [] + text_chars
-            else:
-               # filtered/escaped
-               tag_text = self.__filter_text(text_chars)
+   def check_input(self, html):
+      # raise LimitExceededError where a document goes over FilterLimits.max_input
+      max_input = self.limits.max_input
+      if len(html) > max_input:
+         self.html = html
+         raise self.__limit_error('max_input', 'Input limit of %d characters exceeded' % (max_input,), max_input)
 
-            # start of tag (modifies state)
-            tag_output = self.__filter_tag()
+   def filter_to(self, html, writer):
+      if self.limits is not None and self.limits.max_input is not None:
+         self.check_input(html)
 
-            if self.state == 'script-data-less-than-sign':
-               # tag was not filtered, append the consumed text
-               if is_script_processed:
-                  text_chars.append('<')
-                  text_chars.append(self.curr_char)
+      self.html = html
+      self.writer = writer
+      if self.stats is not None:
+         self.stats.input_chars += len(html)
 
-               self.state = 'script-data'
-            else:
-               self.filtered_html += tag_text
-               
-               text_chars = []
-               self.filtered_html.append(tag_output)
-         else:
-            # any other symbol
-            if self.state == 'script-data' and not is_script_processed:
-               pass
-            elif self.state == 'skip-data':
-               pass # skip
-            else:
-               # collect text characters
-               text_chars.append(self.curr_char)
+      self.__process(final=True)
+      try:
+         self.__check_closed()
+      finally:
+         writer.write(self.__drain())
+
+   def feed(self, chunk):
+      if self.stats is not None:
+         self.stats.input_chars += len(chunk)
+
+      self.input_size += len(chunk)
+      if self.limits is not None and self.limits.max_input is not None and self.input_size > self.limits.max_input:
+         raise self.__limit_error('max_input', 'Input limit of %d characters exceeded' % (self.limits.max_input,))
+
+      self.pending_chunks.append(chunk)
+      self.pending_size += len(chunk)
+
+      if self.waiting_for is not None:
+         if self.waiting_for in chunk:
+            # any more input could complete the pending tag
+            self.waiting_for = ''
+
+         if self.waiting_for != '' or self.pending_size < self.retry_size:
+            # the pending tag can't be completed yet, or was read again too recently
+            return ''
+
+      self.__buffer_pending()
+
+      self.__start_clock()
+      self.__process(final=False)
+      self.__stop_clock()
+      return self.__drain()
+
+   def close(self):
+      self.__buffer_pending()
+
+      self.__start_clock()
+      self.__process(final=True)
+      self.__check_closed()
+
+      return self.__drain()
+
+   def __start_clock(self):
+      # when feeding, only the time spent filtering counts towards the time limit, not the time between chunks
+      if self.time_left is not None:
+         self.deadline = TIMER() + self.time_left
+
+   def __stop_clock(self):
+      if self.time_left is not None:
+         self.time_left = self.deadline - TIMER()
+
+   def __buffer_pending(self):
+      # drop the processed part of the buffer, keeping track of where it leaves the line count
+      self.__location(self.pos)
+      _, self.lines, self.line_start = self.line_cursor
+      self.line_cursor = (0, self.lines, self.line_start)
+
+      self.offset += self.pos
+      self.html = self.html[self.pos:] + ''.join(self.pending_chunks)
+      self.pos = 0
+      self.pending_chunks = []
+      self.pending_size = 0
+      self.waiting_for = None
+
+   def __drain(self):
+      output = ''.join(self.filtered_html)
+      self.filtered_html = []
+      if self.stats is not None:
+         self.stats.output_chars += len(output)
+      return output
 
-      # add any leftover text
-      self.filtered_html += self.__filter_text(text_chars)
+   def __limit_error(self, limit, message, pos=None):
+      location = self.__location(pos)
+      return LimitExceededError('%s %d:%d' % ((message,) + location), limit, *location)
 
+   def __check_closed(self):
       if len(self.tag_stack) != 0:
+         if self.repair:
+            # close everything left open, at the end of the document
+            self.tag_start = len(self.html)
+            self.filtered_html.append(self.__close_tags(len(self.tag_stack), 'closed_at_end'))
+            if self.pending_records:
+               self.__commit_records()
+            return
+
          error = 'Tags not closed: %s' % ', '.join(tag for tag, _ in self.tag_stack)
          raise TagMismatchError(error)
 
-      return ''.join(self.filtered_html)
+   def __close_tags(self, count, reason):
+      # pops the innermost count elements, returning their closing tags
+      closing_tags = []
+      for _ in range(count):
+         tag_name = self.__pop_tag()
+         closing_tags.append('</%s>' % (tag_name,))
+
+         if self.is_recording or self.is_validating:
+            self.__record('repair', tag_name, tag_name, reason)
+
+      return ''.join(closing_tags)
+
+   def __push_tag(self, tag_name, attributes, tag_spec):
+      if self.limits is not None and self.limits.max_depth is not None and self.outer_depth + len(self.tag_stack) >= self.limits.max_depth:
+         raise self.__limit_error('max_depth', 'Nesting depth limit of %d exceeded' % (self.limits.max_depth,), self.tag_start)
+
+      self.tag_stack.append((tag_name, attributes))
+      self.tag_specs.append(tag_spec)
+      if self.tag_paths is not None:
+         self.__push_path(tag_name)
+      if self.open_tags is not None:
+         self.open_tags[tag_name] += 1
+
+   def __pop_tag(self):
+      tag_name, _ = self.tag_stack.pop()
+      self.tag_specs.pop()
+      if self.tag_paths is not None:
+         self.tag_paths.pop()
+      if self.open_tags is not None:
+         self.open_tags[tag_name] -= 1
+      return tag_name
+
+   def __process(self, final):
+      # filter the buffered input from self.pos, stopping at an incomplete tag unless this is the final input
+      html = self.html
+      self.is_final = final
+
+      stats = self.stats
+      if stats is not None:
+         start = TIMER()
+
+      is_script_processed = not self.remove_scripts
+      is_script_escaped = self.compiled_spec.is_script_escaped
+
+      deadline = self.deadline
+      tags_until_deadline_check = DEADLINE_CHECK_TAGS
+
+      pos = self.pos
+      segment_start = pos # where the text before the next tag starts
+      while True:
+         tag_start = html.find('<', pos)
+         if tag_start == -1:
+            tag_start = len(html)
+
+         if self.state == 'script-data' and not is_script_processed:
+            pass
+         elif self.state == 'skip-data':
+            pass # skip
+         elif tag_start > pos:
+            # collect the run of text up to the next tag
+            self.text_parts.append(html[pos:tag_start])
+
+         pos = tag_start
+         if tag_start == len(html):
+            break
+
+         if self.state == 'script-data':
+            next_char = html[tag_start + 1:tag_start + 2]
+            if next_char == '' and not final:
+               self.waiting_for = ''
+               break
+
+            if next_char != '/':
+               # script-data-less-than-sign: not a tag, keep the "<" and the character it consumed
+               if is_script_processed:
+                  self.text_parts.append(html[tag_start:tag_start + 2])
+
+               pos = tag_start + 2
+               continue
+
+         if not final and html.find('>', tag_start) == -1:
+            self.waiting_for = '>'
+            break
+
+         if deadline is not None:
+            tags_until_deadline_check -= 1
+            if tags_until_deadline_check == 0:
+               tags_until_deadline_check = DEADLINE_CHECK_TAGS
+               self.__check_deadline(tag_start)
+
+         if self.clean_tags is not None and self.state == 'data' and self.__replay_clean_tag(tag_start, segment_start):
+            pos = segment_start = self.pos + 1
+            continue
+
+         state, tag_removing, stack_size = self.state, self.tag_removing, len(self.tag_stack)
+
+         # collect tag text so far
+         if self.held_tag_text is not None:
+            # already filtered before the tag was found to be incomplete
+            tag_text, self.held_tag_text = self.held_tag_text, None
+         else:
+            tag_text = self.__collected_text(is_script_escaped, validating=self.is_validating)
+
+         # start of tag (modifies state)
+         self.pos = tag_start
+         try:
+            tag_output = self.__filter_tag()
+            if self.pos >= len(html) and not final:
+               raise _NeedMoreInput('>')
+         except _TagChanged:
+            # filter the tag again, recording what was changed
+            self.__restore(state, tag_removing, stack_size)
+            self.is_recording = True
+            self.pos = tag_start
+            tag_output = self.__filter_tag()
+         except _NeedMoreInput as error:
+            # wait for the rest of the tag, and filter it again
+            self.__restore(state, tag_removing, stack_size)
+            self.waiting_for = error.args[0]
+
+            # the text before the tag is held back with the tag, so it isn't emitted with the text so far
+            self.held_tag_text = tag_text
+            self.text_parts = []
+            self.held_parts = 0
+
+            # a tag which is read again is only read once more after as much input again has arrived,
+            # so a long tag arriving in many small chunks is read in linear time
+            self.retry_size = len(html) if tag_start == 0 else 0
+            break
+
+         if self.is_validating:
+            self.__check_clean(segment_start, tag_start, tag_text, tag_output)
+            self.is_recording = False # in case the tag was filtered again, and turned out to be clean
+            segment_start = self.pos + 1
+            if self.clean_tags is not None and state == self.state == 'data':
+               self.__remember_clean_tag(tag_start, stack_size)
+         else:
+            self.filtered_html.append(tag_text)
+            self.filtered_html.append(tag_output)
+
+         self.text_parts = []
+         self.held_parts = 0
+
+         if self.pending_records:
+            self.__commit_records()
+
+         if self.writer is not None and len(self.filtered_html) >= WRITE_BUFFER_FRAGMENTS:
+            self.writer.write(self.__drain())
+
+         # continue after the tag's closing '>'
+         pos = self.pos + 1
+
+      self.pos = min(pos, len(html))
+
+      if final and self.is_validating:
+         self.__check_clean_text(segment_start, len(html), self.__collected_text(is_script_escaped, validating=True))
+      elif final:
+         # add any leftover text (the same way as text before a tag, e.g. the contents of an unclosed script)
+         self.filtered_html.append(self.__collected_text(is_script_escaped))
+         self.text_parts = []
+         self.held_parts = 0
+      elif self.text_parts and self.text_filter is None:
+         # emit the text so far, holding back anything which could be the start of an entity
+         if self.state == 'script-data' and not is_script_escaped:
+            self.filtered_html.append(''.join(self.text_parts))
+            self.text_parts = []
+            self.held_parts = 0
+         elif self.held_parts > 0 and all(ENTITY_CHARS_MATCH.match(part) for part in self.text_parts[self.held_parts:]):
+            # the text added since still continues the possible entity, so keep holding it back without joining it up again
+            self.held_parts = len(self.text_parts)
+         else:
+            text = ''.join(self.text_parts)
+            entity_start = text.rfind('&')
+            if entity_start == -1 or not PARTIAL_ENTITY_MATCH.match(text, entity_start):
+               entity_start = len(text)
+
+            self.filtered_html.append(self.__filter_text([text[:entity_start]]))
+            self.text_parts = [text[entity_start:]] if entity_start < len(text) else []
+            self.held_parts = len(self.text_parts)
+
+      if stats is not None:
+         stats.add_time('process', TIMER() - start)
+
+   def __collected_text(self, is_script_escaped, validating=False):
+      if validating and self.state == 'data' and self.text_filter is None:
+         # all of the text in the document since the last tag, which is checked in place, see __check_clean_text
+         return None
+
+      if self.state == 'script-data' and not is_script_escaped:
+         # un-modified
+         return ''.join(self.text_parts)
+
+      # filtered/escaped
+      return self.__filter_text(self.text_parts)
+
+   def __restore(self, state, tag_removing, stack_size):
+      # undo the elements opened by the tag being filtered, and anything it has recorded
+      self.state, self.tag_removing = state, tag_removing
+      if self.open_tags is not None:
+         for tag_name, _ in self.tag_stack[stack_size:]:
+            self.open_tags[tag_name] -= 1
+      del self.tag_stack[stack_size:]
+      del self.tag_specs[stack_size:]
+      if self.tag_paths is not None:
+         del self.tag_paths[stack_size + 1:]
+      del self.pending_records[:]
+
+   def __check_clean(self, segment_start, tag_start, tag_text, tag_output):
+      # raise _NotClean if the output for the text from segment_start, and the tag after it, differs from the input
+      self.__check_clean_text(segment_start, tag_start, tag_text)
+
+      html = self.html
+      tag_end = self.pos + 1
+      if tag_output is None:
+         # an opening tag which was checked in place
+         pass
+      elif len(tag_output) != tag_end - tag_start or not html.startswith(tag_output, tag_start):
+         for kind, tag_name, name, reason, rule in self.pending_records:
+            if reason is not None:
+               raise _NotClean(reason, tag_name, name, tag_start)
+
+         raise _NotClean('tag_rewritten', None, None, tag_start)
+
+      del self.pending_records[:]
+
+   def __remember_clean_tag(self, tag_start, stack_size):
+      # a clean tag either opens an element, closes one, or is a void element
+      tag = self.html[tag_start:self.pos + 1]
+      if len(self.tag_stack) > stack_size:
+         tag_name, attributes = self.tag_stack[-1]
+         self.clean_tags[tag] = ('open', tag_name, attributes, self.tag_specs[-1])
+      elif len(self.tag_stack) < stack_size:
+         self.clean_tags[tag] = ('close', self.__tag_name(tag_start), None, None)
+      else:
+         self.clean_tags[tag] = ('void', None, None, None)
+
+   def __tag_name(self, tag_start):
+      match = TAG_NAME_MATCH.match(self.html, tag_start + 2)
+      return match.group().lower()
+
+   def __replay_clean_tag(self, tag_start, segment_start):
+      # a tag seen before needs only its text checked, and its effect on the element stack repeated
+      html = self.html
+      tag_end = html.find('>', tag_start)
+      if tag_end == -1:
+         return False
+
+      clean_tag = self.clean_tags.get(html[tag_start:tag_end + 1])
+      if clean_tag is None:
+         return False
+
+      kind, tag_name, attributes, tag_spec = clean_tag
+      if kind == 'close' and not (self.tag_stack and self.tag_stack[-1][0] == tag_name):
+         return False
+
+      self.__check_clean_text(segment_start, tag_start, self.__collected_text(False, validating=True))
+      self.text_parts = []
+      self.held_parts = 0
+
+      self.tag_start = tag_start
+      self.pos = tag_end
+      if kind == 'open':
+         self.__push_tag(tag_name, attributes, tag_spec)
+      elif kind == 'close':
+         self.__pop_tag()
+
+      return True
+
+   def __check_clean_text(self, start, end, text):
+      html = self.html
+      if text is None:
+         # text which escaping would leave as it is
+         if CLEAN_TEXT_MATCH.match(html, start, end):
+            return
+         text = self.purify_text(html[start:end])
+
+      if len(text) != end - start or not html.startswith(text, start):
+         # the first character which is changed
+         pos = start + len(os.path.commonprefix([text, html[start:end]]))
+         raise _NotClean('text_changed', None, None, pos)
+
+   def __check_deadline(self, pos):
+      if TIMER() > self.deadline:
+         raise self.__limit_error('time_limit', 'Time limit of %gs exceeded' % (self.limits.time_limit,), pos)
+
+   def __record(self, kind, tag_name, name, reason, rule=None):
+      self.pending_records.append((kind, tag_name, name, reason, rule))
+
+   def __commit_records(self):
+      # pass on the records of a completed tag
+      stats, report = self.stats, self.report
+
+      location = None
+      if report is not None and report.events is not None:
+         location = self.__location(self.tag_start)
+
+      for kind, tag_name, name, reason, rule in self.pending_records:
+         if stats is not None:
+            stats.record(kind, name, reason)
+         if report is not None:
+            report.record(kind, tag_name, name, reason, rule, location)
+
+      del self.pending_records[:]
 
    def __get_tag_spec(self, tag_name):
-      tag_spec = self.spec.get(tag_name, None)
+      tag_spec = self.compiled_spec.tags.get(tag_name, None)
 
       if callable(tag_spec):
-         tag_spec = tag_spec(tag_name, self.tag_stack)
+         if tag_name in self.compiled_spec.pure_tags:
+            # the result only depends on the tag name and the names of the enclosing tags
+            key = (tag_name, self.tag_paths[-1])
+            if key in self.tag_spec_memo:
+               return self.tag_spec_memo[key]
+
+            if len(self.tag_spec_memo) >= MAX_PURE_RESULTS:
+               self.tag_spec_memo.clear()
+
+            tag_spec = self.compiled_spec.compile_tag(self.__call_tag_spec(tag_spec, tag_name))
+            self.tag_spec_memo[key] = tag_spec
+         else:
+            tag_spec = self.compiled_spec.compile_tag(self.__call_tag_spec(tag_spec, tag_name))
 
       return tag_spec
 
-   def __escape_data(self, char, include_quotes=False):
-      if char in HTML_ESCAPE_CHARS:
-         return HTML_ESCAPE_CHARS[char]
-      elif include_quotes and char in HTML_ESCAPE_QUOTES:
-         return HTML_ESCAPE_QUOTES[char]
-      else:
-         return char
+   def __push_path(self, tag_name):
+      # the same names of elements, nested the same way, always get the same id
+      key = (self.tag_paths[-1], tag_name)
+      path_id = self.path_ids.get(key)
+      if path_id is None:
+         path_id = self.path_ids[key] = len(self.path_ids) + 1
+
+      self.tag_paths.append(path_id)
 
-   def __filter_text(self, text_chars):
-      filtered_html = []
+   def __call_tag_spec(self, tag_spec_function, tag_name):
+      if self.stats is not None:
+         return self.stats.timed('tag_spec', tag_spec_function, tag_name, self.tag_stack)
 
+      return tag_spec_function(tag_name, self.tag_stack)
+
+   def __filter_text(self, text_parts):
       # filter collected text
-      # and save it into filtered_html
+      stats = self.stats
+      if stats is not None:
+         start = TIMER()
+
       if self.text_filter is not None:
-         filtered_text = self.text_filter(''.join(text_chars), self.tag_stack)
+         text = ''.join(text_parts)
+         if stats is not None:
+            filtered_text = stats.timed('text_filter', self.text_filter, text, self.tag_stack)
+         else:
+            filtered_text = self.text_filter(text, self.tag_stack)
 
-         # ensure filtered text adheres to the html spec
-         filtered_text = filter_html(filtered_text, self.spec, allowed_schemes=self.allowed_schemes, remove=self.removals)
+         if self.limits is not None:
+            self.__check_text_expansion(text, filtered_text)
 
-         filtered_html += list(filtered_text)
+         if '<' not in filtered_text:
+            # no tags (e.g. the text was returned unchanged), so there's nothing to parse
+            filtered_text = self.purify_text(filtered_text)
+         else:
+            # ensure filtered text adheres to the html spec
+            text_html_filter = self.html_filter.text_html_filter
+            if text_html_filter is None:
+               text_html_filter = self.html_filter.text_html_filter = HTMLFilter(self.compiled_spec, remove=self.removals,
+                  limits=self.limits, repair=self.repair)
+
+            # within the limits of this document, as if the text filter's output were part of it
+            text_context = _ParseContext(text_html_filter)
+            text_context.outer_depth = self.outer_depth + len(self.tag_stack)
+            text_context.deadline = self.deadline
+            filtered_text = text_context.filter(filtered_text)
       else:
-         filtered_html += list(self.purify_text(''.join(text_chars)))
+         filtered_text = self.purify_text(''.join(text_parts))
 
+      if stats is not None:
+         stats.add_time('filter_text', TIMER() - start)
 
-      return filtered_html
+      return filtered_text
 
-   def __char_gen(self):
-      self.curr_char = ''
-      self.row = 0
-      self.line = 0
-      for c in self.html:
-         self.curr_char = c
-         yield c
+   def __check_text_expansion(self, text, filtered_text):
+      max_text_expansion = self.limits.max_text_expansion
+      if max_text_expansion is not None and len(filtered_text) > len(text) * max_text_expansion + TEXT_EXPANSION_ALLOWANCE:
+         raise self.__limit_error('max_text_expansion', 'Text filter expansion limit of %gx exceeded' % (max_text_expansion,))
 
-         self.row += 1
-         if c == '\n':
-            self.line += 1
-            self.row = 0
+      if self.deadline is not None:
+         self.__check_deadline(self.pos)
 
-   def __next(self):
-      try:
-         return next(self.chars)
-      except StopIteration:
-         self.curr_char = ''
-         return ''
+   def __curr_char(self):
+      # the character at the current position, or '' at the end of the input
+      return self.html[self.pos:self.pos + 1]
+
+   def __location(self, pos=None):
+      # line and column of the current (or a given) position, only worked out for error messages and reports
+      if pos is None:
+         pos = self.pos
+
+      # lines are counted on from the last position asked for, as positions are usually asked for in order
+      counted, line, line_start = self.line_cursor
+      if pos < counted:
+         counted, line, line_start = 0, self.lines, self.line_start
+
+      newlines = self.html.count('\n', counted, pos)
+      if newlines > 0:
+         line += newlines
+         line_start = self.offset + self.html.rfind('\n', counted, pos) + 1
+
+      self.line_cursor = (pos, line, line_start)
+
+      return line, self.offset + pos - line_start
 
    def __filter_tag(self):
       tag_output = ''
 
-      assert self.curr_char == '<'
+      assert self.__curr_char() == '<'
+      self.tag_start = self.pos
 
-      self.__next()
-      if self.curr_char == '/':
-         self.__next()
-         # </closing tag>, curr_char is first character of tag name
+      self.pos += 1
+      curr_char = self.__curr_char()
+      if curr_char == '/':
+         self.pos += 1
+         # </closing tag>, pos is at the first character of tag name
          tag_output = self.__filter_closing_tag()
-      elif self.curr_char == '!' and self.state != 'script-data':
+      elif curr_char == '!':
          # <!-- comment tag -->
          self.__extract_remaining_tag()
       else:
-         # <opening tag>, curr_char is first character of tag name
-         if self.state == 'script-data':
-            self.state = 'script-data-less-than-sign'
-         else:
-            tag_output = self.__filter_opening_tag()
+         # <opening tag>, pos is at the first character of tag name
+         tag_output = self.__filter_opening_tag()
 
-      assert (self.state == 'script-data-less-than-sign' or self.curr_char == '>' or self.curr_char == '')
+      assert self.__curr_char() in ('>', '')
 
       return tag_output
 
    def __extract_whitespace(self):
-      whitespace = []
-
-      if self.curr_char.isspace():
-         whitespace.append(self.curr_char)
-         while self.__next().isspace():
-            whitespace.append(self.curr_char)
-
-      return ''.join(whitespace)
+      match = WHITESPACE_MATCH.match(self.html, self.pos)
+      self.pos = match.end()
+      return match.group()
 
    def __extract_tag_name(self):
-      tag_name = []
-
-      if self.curr_char.lower() in self.tag_chars:
-         tag_name.append(self.curr_char.lower())
-         while self.__next().lower() in self.tag_chars:
-            tag_name.append(self.curr_char.lower())
-
-      return ''.join(tag_name)
+      match = TAG_NAME_MATCH.match(self.html, self.pos)
+      self.pos = match.end()
+      return match.group().lower()
 
    def __extract_attribute_name(self):
-      attr_name = []
-
-      if self.curr_char.lower() in self.attr_chars:
-         attr_name.append(self.curr_char.lower())
-         while self.__next().lower() in self.attr_chars:
-            attr_name.append(self.curr_char.lower())
-
-      return ''.join(attr_name)
+      match = ATTRIBUTE_NAME_MATCH.match(self.html, self.pos)
+      self.pos = match.end()
+      return match.group().lower()
 
    def __extract_remaining_tag(self):
-      remaining_tag = []
-
-      if self.curr_char != '>':
-         remaining_tag.append(self.curr_char)
-         while self.__next() != '>' and self.curr_char != '':
-            remaining_tag.append(self.curr_char)
+      end = self.html.find('>', self.pos)
+      if end == -1:
+         end = len(self.html)
 
-      return ''.join(remaining_tag)
+      remaining_tag = self.html[self.pos:end]
+      self.pos = end
+      return remaining_tag
 
    def __follow_aliases(self, tag_name):
-      alias_attributes = []
-      while tag_name in self.spec and isinstance(self.spec[tag_name], str):
-         tag_parts = self.spec[tag_name].split(' ') # follow aliases
-         tag_name = tag_parts[0]
-         if len(tag_parts) > 1:
-            alias_attributes += tag_parts[1:]
+      alias = self.compiled_spec.aliases.get(tag_name)
+      if alias is None:
+         return tag_name, []
 
-      return tag_name, alias_attributes
+      tag_name, alias_attributes = alias
+      return tag_name, list(alias_attributes)
 
    def __filter_opening_tag(self):
       tag_output = []
@@ -494,17 +2427,65 @@ class HTMLFilter(object):
          self.tag_removing = tag_name
          self.state = 'skip-data'
 
-      tag_name, attributes = self.__follow_aliases(tag_name)
-      
       is_recognised_tag = tag_spec is not None and tag_spec != False      
 
+      if self.is_recording:
+         reason = None
+         if tag_spec == False or tag_name in self.removals:
+            reason = 'removed'
+         elif not is_recognised_tag:
+            reason = 'not_allowed'
+         self.__record('tag', tag_name, tag_name, reason)
+
+      # when validating, each part of the output is compared with the input where it would be, instead of building
+      # the output, and _TagChanged is raised at the first difference
+      is_checking = self.is_validating and not self.is_recording
+      if is_checking and not (is_recognised_tag and self.html.startswith(tag_name, self.tag_start + 1)):
+         raise _TagChanged()
+
+      alias_name, attributes = self.__follow_aliases(tag_name)
+      if alias_name != tag_name:
+         if is_checking:
+            raise _TagChanged()
+         tag_name = alias_name
+         tag_spec = self.__get_tag_spec(tag_name) if is_recognised_tag else None
+
       if is_recognised_tag:
-         while self.curr_char != '>' and self.curr_char != '':
+         # the spec used for this element's attributes, and its closing tag
+         attribute_spec = tag_spec if isinstance(tag_spec, _CompiledTag) else _EMPTY_TAG
+
+         max_attributes = None
+         if self.limits is not None:
+            max_attributes = self.limits.max_attributes
+         num_attributes = 0
+
+         html = self.html
+         output_end = self.tag_start + 1 + len(tag_name) # where the output checked so far ends in the input
+
+         while self.__curr_char() not in ('>', ''):
             self.__extract_whitespace()
-            attribute = self.__filter_attribute(tag_name)
+
+            num_attributes += 1
+            if max_attributes is not None and num_attributes > max_attributes:
+               raise self.__limit_error('max_attributes', 'Attribute limit of %d exceeded' % (max_attributes,), self.tag_start)
+
+            attribute = self.__filter_attribute(tag_name, attribute_spec)
             if attribute is not None:
                attributes.append(attribute)
 
+               if is_checking:
+                  if html[output_end:output_end + 1] != ' ' or not html.startswith(attribute, output_end + 1):
+                     raise _TagChanged()
+                  output_end += 1 + len(attribute)
+
+         if is_checking:
+            if output_end != self.pos or self.__curr_char() != '>':
+               raise _TagChanged()
+
+            if tag_name not in VOID_ELEMENTS:
+               self.__push_tag(tag_name, attributes, tag_spec)
+            return None
+
          tag_output = ['<%s' % (tag_name,)]
 
          if len(attributes) > 0:
@@ -513,7 +2494,7 @@ class HTMLFilter(object):
          tag_output.append('>')
 
          if tag_name not in VOID_ELEMENTS:
-            self.tag_stack.append((tag_name, attributes))
+            self.__push_tag(tag_name, attributes, tag_spec)
 
       else:
          self.__extract_remaining_tag()
@@ -531,141 +2512,153 @@ class HTMLFilter(object):
          self.state = 'data'
       elif tag_name == self.tag_removing and self.state == 'skip-data':
          self.state = 'data'
-         self.tag_removing == None
+         self.tag_removing = None
       
       tag_name, _ = self.__follow_aliases(tag_name)
 
-      tag_spec = self.__get_tag_spec(tag_name)
+      if self.tag_stack and self.tag_stack[-1][0] == tag_name:
+         # closing the current element, so re-use the spec it was opened with
+         tag_spec = self.tag_specs[-1]
+      else:
+         tag_spec = self.__get_tag_spec(tag_name)
       is_recognised_tag = (tag_spec is not None) and (tag_spec != False)
 
       if is_recognised_tag and tag_name not in VOID_ELEMENTS:
          self.__extract_whitespace()
-         if self.curr_char == '>':
-            tag_output = '</%s>' % (tag_name,)
-
-            if len(self.tag_stack) == 0:
-               raise TagMismatchError('Closing tag </%s> not found %d:%d' % (tag_name, self.line, self.row)) 
-
-            opening_tag_name, _ = self.tag_stack.pop()
-            if opening_tag_name != tag_name:
-               raise TagMismatchError('Opening tag <%s> does not match closing tag </%s> %d:%d' % (opening_tag_name, tag_name, self.line, self.row))
+         self.__extract_remaining_tag()
+         if self.__curr_char() == '>':
+            if self.tag_stack and self.tag_stack[-1][0] == tag_name:
+               self.__pop_tag()
+               tag_output = '</%s>' % (tag_name,)
+            elif self.repair:
+               tag_output = self.__repair_closing_tag(tag_name)
+            elif len(self.tag_stack) == 0:
+               raise TagMismatchError('Closing tag </%s> not found %d:%d' % ((tag_name,) + self.__location()))
+            else:
+               opening_tag_name = self.tag_stack[-1][0]
+               raise TagMismatchError('Opening tag <%s> does not match closing tag </%s> %d:%d' % ((opening_tag_name, tag_name) + self.__location()))
       else:
          self.__extract_remaining_tag()
 
       return tag_output
 
-   def __filter_attribute(self, tag_name):
-      tag_spec = self.__get_tag_spec(tag_name)
-      allowed_attributes = tag_spec.keys()
-      
+   def __repair_closing_tag(self, tag_name):
+      if self.open_tags[tag_name] == 0:
+         # closes nothing which is open, so drop it
+         if self.is_recording or self.is_validating:
+            # (closing tags which aren't clean aren't filtered again when validating, so repairs are always recorded)
+            self.__record('repair', tag_name, tag_name, 'dropped_closing_tag')
+         return ''
+
+      # close the elements inside the one being closed
+      num_inside = 0
+      while self.tag_stack[-1 - num_inside][0] != tag_name:
+         num_inside += 1
+
+      closing_tags = self.__close_tags(num_inside, 'closed_implicitly')
+      self.__pop_tag()
+      return closing_tags + '</%s>' % (tag_name,)
+
+   def __filter_attribute(self, tag_name, tag_spec):
       attribute_name = self.__extract_attribute_name()
-      
+
       self.__extract_whitespace()
 
-      is_in_spec = (attribute_name in allowed_attributes)
-      is_in_globals = (attribute_name in self.global_attrs)
-      is_wildcard = ('*' in allowed_attributes)
-      is_regex = any(
-         regex.match(attribute_name)
-         for regex in allowed_attributes
-         if isinstance(regex, PATTERN_TYPE)
-      ) or ('^$' in allowed_attributes)
-      
-      is_allowed = is_in_spec or is_in_globals or is_wildcard or is_regex
+      curr_char = self.__curr_char()
 
       value = None
-      if self.curr_char == '=':
-         self.__next() # consume the '='
-         value = self.__filter_value(tag_name, attribute_name, is_regex=is_regex)
-         if value is None:
-            is_allowed = False
+      if curr_char == '=':
+         self.pos += 1 # consume the '='
+         value = self.__filter_value(tag_spec, tag_name, attribute_name)
 
-      elif self.curr_char not in self.attr_chars and self.curr_char != '>':
+      elif curr_char not in self.attr_chars and curr_char != '>':
          # if the current character is invalid, but also isn't the closing character
          # (this includes skipping the '/' in self-closing tags)
-         self.__next() # skip invalid characters
-         is_allowed = False
+         self.pos += 1 # skip invalid characters
+
+         if self.is_recording and attribute_name:
+            self.__record('attribute', tag_name, attribute_name, 'malformed')
 
-      elif tag_spec is not None and tag_spec.get(attribute_name) == "boolean":
+      elif attribute_name in tag_spec.booleans:
          # No equals sign, so this is a boolean attribute that is present
          value = True
-      
-      if is_allowed:
-         if value == True:
-            return '%s' % attribute_name
-         elif value is not None:
-            return  '%s=%s' % (attribute_name, value)
 
-      return None
+         if self.is_recording:
+            self.__record('attribute', tag_name, attribute_name, None)
+
+      elif self.is_recording and attribute_name:
+         self.__record('attribute', tag_name, attribute_name, 'no_value')
 
-   def __is_valid_unquoted_attribute_character(self, character):
-      return character not in UNQUOTED_INVALID_VALUES and not character.isspace()
+      if value == True:
+         return '%s' % attribute_name
+      elif value is not None:
+         return  '%s=%s' % (attribute_name, value)
 
-   def __filter_value(self, tag_name, attribute_name, is_regex):
-      value_chars = []
+      return None
 
+   def __filter_value(self, tag_spec, tag_name, attribute_name):
       num_spaces = len(self.__extract_whitespace())
 
+      curr_char = self.__curr_char()
+
       quote = '"'
-      if self.curr_char == "'" or self.curr_char == '"':
-         quote = self.curr_char
+      if curr_char == "'" or curr_char == '"':
+         quote = curr_char
 
-         while self.__next() != quote:
-            if self.curr_char == '':
-               raise HTMLSyntaxError('Attribute quote not closed: <' + tag_name + ' ' + attribute_name + '>')
+         end = self.html.find(quote, self.pos + 1)
+         if end == -1:
+            if not self.is_final:
+               raise _NeedMoreInput(quote)
+            raise HTMLSyntaxError('Attribute quote not closed: <' + tag_name + ' ' + attribute_name + '>')
 
-            value_chars.append(self.curr_char)
+         value = self.html[self.pos + 1:end]
 
          # consume the quote
-         self.__next()
-      elif num_spaces == 0 and self.__is_valid_unquoted_attribute_character(self.curr_char):
+         self.pos = end + 1
+      elif num_spaces == 0:
          # parse unquoted attributes
-         value_chars.append(self.curr_char)
-         while self.__is_valid_unquoted_attribute_character(self.__next()):
-            value_chars.append(self.curr_char)
+         match = UNQUOTED_VALUE_MATCH.match(self.html, self.pos)
+         self.pos = match.end()
+         value = match.group()
+      else:
+         value = ''
 
-      value = ''.join(value_chars)
-      
-      rules = None
-      global_rules = None
+      if self.limits is not None and self.limits.max_value_length is not None and len(value) > self.limits.max_value_length:
+         raise self.__limit_error('max_value_length', 'Attribute value limit of %d characters exceeded' % (self.limits.max_value_length,), self.tag_start)
 
       # retrieve element-specific rules for this attribute
-      tag_spec = self.__get_tag_spec(tag_name)
-      if tag_spec is not None:
-         if attribute_name in tag_spec:
-            rules = tag_spec[attribute_name]
-         elif '*' in tag_spec:
-            rules = tag_spec['*']
-         elif '^$' in tag_spec:
-            for pair in tag_spec['^$']:
-               if isinstance(pair, list):
-                  regex, value = pair
-                  if isinstance(regex, PATTERN_TYPE) and regex.match(attribute_name):
-                     rules = value
-                     break
-         elif is_regex:
-            for regex, regex_rules in tag_spec.items():
-               if isinstance(regex, PATTERN_TYPE) and regex.match(attribute_name):
-                  rules = regex_rules
-                  break
-         
+      rule = tag_spec.get_rule(attribute_name)
 
       # retrieve rules for this attribute global to all elements
-      if attribute_name in self.global_attrs:
-         global_rules = self.global_attrs[attribute_name]
-      
+      global_rule = self.compiled_spec.global_attrs.get(attribute_name)
+
+      stats = self.stats
+
       # at least some rules must exist to continue
-      if rules is None and global_rules is None:
+      if rule is None and global_rule is None:
+         if self.is_recording:
+            self.__record('attribute', tag_name, attribute_name, 'not_allowed')
          return None
 
       new_value = None
+      applied_rule = rule
       # purify the attribute value using the element-specific rules
-      if rules is not None:
-         new_value = self.__purify_attribute(attribute_name, value, rules)
+      if rule is not None:
+         if stats is not None:
+            new_value = stats.timed(getattr(rule, 'stage', 'purify_value'), rule, value, attribute_name)
+         else:
+            new_value = rule(value, attribute_name)
 
       # if it filtered out the value, try the global rules for this attribute
-      if global_rules is not None and (new_value is None or new_value == ''):
-         new_value = self.__purify_attribute(attribute_name, value, global_rules)
+      if global_rule is not None and (new_value is None or new_value == ''):
+         applied_rule = global_rule
+         if stats is not None:
+            new_value = stats.timed(getattr(global_rule, 'stage', 'purify_value'), global_rule, value, attribute_name)
+         else:
+            new_value = global_rule(value, attribute_name)
+
+      if self.is_recording:
+         self.__record_value(tag_name, attribute_name, value, new_value, applied_rule)
 
       if new_value is None:
          return None
@@ -675,236 +2668,252 @@ class HTMLFilter(object):
       else:
          return '%s%s%s' % (quote, new_value, quote)
 
-   def __purify_attribute(self, attribute_name, value, rules):
-      
-      value, purified = self.purify_value(value, rules, attribute_name=attribute_name)
-
-      if not purified:
-         if attribute_name == "class" and isinstance(rules, list):
-            candidate_values = value.split(' ')
-            allowed_values_set = set()
-            allowed_values = []
-
-            for candidate in candidate_values:
-               for rule in rules:
-                  new_class_value = None
-                  if isinstance(rule, PATTERN_TYPE):
-                     new_class_value = self.purify_regex(candidate, rule)
-                  elif callable(rule):
-                     new_class_value = rule(value)
-                  elif candidate == rule:
-                     new_class_value = candidate
-
-                  if new_class_value and new_class_value not in allowed_values_set:
-                     allowed_values_set.add(new_class_value)
-                     allowed_values.append(new_class_value)
-
-            if len(allowed_values) > 0:
-               value = ' '.join(allowed_values)
-            else:
-               value = None
-         elif attribute_name == "style" and isinstance(rules, dict):
-            candidate_values = value.split(';')
-
-            # map purify_style over each style
-            allowed_values = [self.purify_style(style, rules) for style in candidate_values]
-            
-            # filter out invalid styles
-            allowed_values = [style_value for style_value in allowed_values if style_value]
-
-            if len(allowed_values) > 0:
-               value = ';'.join(allowed_values) + ';'
-            else:
-               value = None
-         elif value not in rules:
-            value = None
-
-      return value
-
-   def purify_value(self, value, rules, attribute_name=None):
-      purified = True
+   def __record_value(self, tag_name, attribute_name, value, new_value, applied_rule):
+      description = getattr(applied_rule, 'rule', None)
 
-      if UNICODE_ESCAPE in value:
-         # disallow &# in values (can be used for encoding disallowed characters)
-         value = None
-      elif rules == "*":
-         # leave the value as-is
-         value = value
-      elif isinstance(rules, PATTERN_TYPE):
-         value = self.purify_regex(value, rules)
-      elif rules == "boolean":
-         if value == "" or (attribute_name is not None and value == attribute_name):
-            value = True
-         else:
-            value = None
-      elif rules == "url":
-         value = value.strip()
-         value = self.purify_url(value)
-      elif rules == "url|empty":
-         value = value.strip()
-         if value != '':
-            value = self.purify_url(value)
-      elif rules == "color":
-         value = self.purify_color(value)
-      elif rules == "measurement":
-         value = self.purify_regex(value, MEASUREMENT_MATCH)
-      elif rules == "int":
-         value = self.purify_int(value)
-      elif rules == "alpha":
-         if value == '':
-            value = None
-         else:
-            value = self.purify_set(value, string.ascii_letters)
-      elif rules == "alphanumeric":
-         if value == '':
-            value = None
-         else:
-            value = self.purify_set(value, string.ascii_letters + string.digits)
-      elif rules == "alpha|empty":
-         if value != '':
-            value = self.purify_set(value, string.ascii_letters)
-      elif rules == "alphanumeric|empty":
-         if value != '':
-            value = self.purify_set(value, string.ascii_letters + string.digits)
-      elif rules == "text":
-         value = self.purify_text(value, include_quotes=True)
-      elif isinstance(rules, str) and rules.startswith('[') and rules.endswith(']'):
-         if value == '':
-            value = None
-         else:
-            value = self.purify_set(value, rules[1:-1])
-      elif callable(rules):
-         value = rules(value)
-      else:
-         purified = False
-
-      if value is None and rules in INVALID_ATTRIBUTE_REPLACEMENTS:
-         value = INVALID_ATTRIBUTE_REPLACEMENTS[rules]
+      if new_value is None:
+         self.__record('attribute', tag_name, attribute_name, 'invalid_value', description)
+         return
 
-      return value, purified
+      self.__record('attribute', tag_name, attribute_name, None, description)
+      if getattr(applied_rule, 'stage', None) == 'purify_url' and new_value != value:
+         self.__record('url', tag_name, attribute_name, 'rewritten', description)
 
-   def __escape_pattern(self, pattern, value, escaper):
-      entities = set(pattern.findall(value))
-      new_text = []
-      for chunk in pattern.split(value):
-         if chunk not in entities:
-            chunk = ''.join([escaper(char) for char in chunk])
-         new_text.append(chunk)
+def compile_spec(spec, allowed_schemes=DEFAULT_SCHEMES):
+   """
+   Pre-processes a whitelist specification into a CompiledSpec, which can be
+   passed to HTMLFilter or filter_html in place of the spec dictionary
+   """
+   return CompiledSpec(spec, allowed_schemes)
 
-      return ''.join(new_text)
+def filter_html(html, spec, **kwargs):
+   html_filter = HTMLFilter(spec, **kwargs)
+   return html_filter.filter(html)
 
-   def purify_style(self, style, rules):
-      assert isinstance(rules, dict)
+def filter_html_report(html, spec, events=False, **kwargs):
+   """ Filters a document, returning (filtered_html, report), where report is a FilterReport of what was removed """
+   report = FilterReport(events=events)
+   html_filter = HTMLFilter(spec, report=report, **kwargs)
+   return html_filter.filter(html), report
 
-      parts = style.split(':')
+def filter_html_async(html, spec, timeout=None, **kwargs):
+   """
+   Returns an awaitable of the filtered document, filtered on a thread pool shared by every call
+   (or straight away, if it is short). Use an AsyncFilter to choose the executor, and to bound the jobs running.
+   """
+   return AsyncFilter(spec, executor=_shared_executor(), **kwargs).filter(html, timeout=timeout)
 
-      if len(parts) != 2:
-         return None
+def filter_html_bytes(data, spec, encoding='utf-8', errors='strict', **kwargs):
+   html_filter = HTMLFilter(spec, **kwargs)
+   return html_filter.filter_bytes(data, encoding, errors)
 
-      name = parts[0].strip()
-      value = parts[1].strip()
+def filter_html_iter(chunks, spec, **kwargs):
+   html_filter = HTMLFilter(spec, **kwargs)
+   return html_filter.filter_iter(chunks)
 
-      if CSS_ESCAPE.match(value):
-         # disallow CSS unicode escaping
-         return None
+def filter_html_to(html, writer, spec, **kwargs):
+   html_filter = HTMLFilter(spec, **kwargs)
+   html_filter.filter_to(html, writer)
+
+def _decode_chunks(chunks, encoding, errors):
+   # a character split between chunks is decoded with the chunk it ends in
+   decoder = codecs.getincrementaldecoder(encoding)(errors)
+   for chunk in chunks:
+      yield decoder.decode(chunk)
+
+   yield decoder.decode(b'', True)
+
+# the filter used by each worker process of filter_many
+_batch_filter = None
+
+def _start_batch_worker(spec, kwargs):
+   global _batch_filter
+   _batch_filter = HTMLFilter(spec, **kwargs)
+
+def _filter_batch_chunk(documents):
+   return list(_batch_filter.filter_batch(documents))
+
+def _batch_chunks(documents, chunksize):
+   documents = iter(documents)
+   while True:
+      chunk = list(itertools.islice(documents, chunksize))
+      if not chunk:
+         return
+      yield chunk
+
+def filter_many(documents, spec, workers=None, chunksize=BATCH_CHUNKSIZE, **kwargs):
+   """
+   Filters an iterable of documents, yielding a FilterResult for each, in the same order.
+   TagMismatchError, HTMLSyntaxError and LimitExceededError are reported on each result instead of being raised.
+
+   With workers > 1 the documents are filtered on a pool of worker processes: the spec
+   (and text_filter) is sent to each worker once, so it must be picklable, and documents
+   are sent in chunks of chunksize, with only a few chunks per worker in flight at a time.
+   """
+   if workers is None or workers <= 1:
+      for result in HTMLFilter(spec, **kwargs).filter_batch(documents):
+         yield result
+      return
+
+   import multiprocessing
+
+   pool = multiprocessing.Pool(workers, _start_batch_worker, (spec, kwargs))
+   try:
+      pending = collections.deque()
+      for chunk in _batch_chunks(documents, chunksize):
+         pending.append(pool.apply_async(_filter_batch_chunk, (chunk,)))
+
+         if len(pending) >= workers * 2:
+            for result in pending.popleft().get():
+               yield result
+
+      while pending:
+         for result in pending.popleft().get():
+            yield result
+   except BaseException:
+      pool.terminate()
+      raise
+   else:
+      pool.close()
+   finally:
+      pool.join()
+
+def _filter_batch_document(html):
+   return _batch_filter.filter(html)
+
+# the thread pool used by filter_html_async and HTMLFilter.afilter, created when first needed
+_async_executor = None
+_async_executor_lock = threading.Lock()
+
+def _shared_executor():
+   global _async_executor
+   with _async_executor_lock:
+      if _async_executor is None:
+         import concurrent.futures
+         _async_executor = concurrent.futures.ThreadPoolExecutor()
+      return _async_executor
+
+def _running_loop():
+   import asyncio
+   get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+   return get_running_loop()
+
+def _cancel_job_with(job, future):
+   # cancel the executor's job if the awaited future is cancelled (e.g. by a timeout)
+   def cancel(future):
+      if future.cancelled():
+         job.cancel()
+   future.add_done_callback(cancel)
+
+def _copy_job_result(job, future):
+   if future.done():
+      return
+
+   if job.cancelled():
+      future.cancel()
+   elif job.exception() is not None:
+      future.set_exception(job.exception())
+   else:
+      future.set_result(job.result())
+
+class AsyncFilter(object):
+   """
+   Filters documents for asyncio code, on an executor so the event loop isn't blocked. filter(html) returns an awaitable.
+
+   By default a thread pool of workers threads is created, or with processes=True a pool of worker processes, each
+   sent the compiled spec once (so it, and any text_filter, must be picklable). What worker processes count can't
+   be sent back, so stats and report can't be used with processes=True. Pass executor to share an existing
+   thread pool instead.
+
+   At most max_jobs documents are given to the executor at a time, the rest wait their turn. Documents shorter
+   than inline_size are filtered straight away, as handing them to the executor would take longer than filtering.
+   A document which is cancelled (or times out) while waiting is never filtered, but one already being filtered
+   on a thread runs to completion and its output is discarded.
+   """
+   def __init__(self, spec, executor=None, workers=None, processes=False, max_jobs=None, inline_size=ASYNC_INLINE_SIZE, **kwargs):
+      if processes and executor is None and (kwargs.get('stats') is not None or kwargs.get('report') is not None):
+         raise ValueError('stats and report are only collected when filtering on threads, not with processes=True')
+
+      self.html_filter = HTMLFilter(spec, **kwargs)
+      kwargs.pop('allowed_schemes', None)
+
+      self.compiled_spec = self.html_filter.compiled_spec
+      self.max_jobs = max_jobs
+      self.inline_size = inline_size
+
+      self.lock = threading.Lock()
+      self.running = 0
+      self.waiting = collections.deque() # (loop, future, html) of documents waiting for the executor
+
+      self.owns_executor = executor is None
+      self.job = self.html_filter.filter
+      if executor is None:
+         import concurrent.futures
+         if processes:
+            executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=_start_batch_worker,
+               initargs=(self.compiled_spec, kwargs))
+            self.job = _filter_batch_document
+         else:
+            executor = concurrent.futures.ThreadPoolExecutor(workers)
 
-      if name in rules:
-         style_rules = rules[name]
-         value, purified = self.purify_value(value, style_rules)
-         if not purified:
-            if value not in style_rules:
-               return None
-         elif value is None or value == '':
-            return None
-      else:
-         return None
+      self.executor = executor
 
-      return ':'.join([name, value])
+   def filter(self, html, timeout=None):
+      """
+      Returns an awaitable of the filtered document, which raises the document's TagMismatchError or HTMLSyntaxError,
+      or asyncio.TimeoutError if it isn't filtered within timeout seconds. Must be called with an event loop running.
+      """
+      loop = _running_loop()
+      future = loop.create_future()
 
-   def purify_color(self, value):
-      value = value.lower()
+      if len(html) < self.inline_size:
+         try:
+            future.set_result(self.html_filter.filter(html))
+         except Exception as error:
+            future.set_exception(error)
+         return future
 
-      if value in HTML_COLORS:
-         return value
+      with self.lock:
+         self.waiting.append((loop, future, html))
+      self.__dispatch()
 
-      if HEX_MATCH.match(value):
-         return value
+      if timeout is not None:
+         import asyncio
+         return asyncio.wait_for(future, timeout)
 
-      if RGB_MATCH.match(value):
-         return value
+      return future
 
-      if RGBA_MATCH.match(value):
-         return value
+   def shutdown(self, wait=True):
+      """ Shuts down the executor, if it was created by this filter """
+      if self.owns_executor:
+         self.executor.shutdown(wait)
 
-      if HSL_MATCH.match(value):
-         return value
+   def __dispatch(self):
+      # hand waiting documents to the executor, while fewer than max_jobs are running
+      while True:
+         with self.lock:
+            if not self.waiting or (self.max_jobs is not None and self.running >= self.max_jobs):
+               return
 
-      if HSLA_MATCH.match(value):
-         return value
+            loop, future, html = self.waiting.popleft()
+            if future.done():
+               continue # cancelled while waiting
 
-      return None
+            self.running += 1
 
-   def purify_url(self, url):
-      # encode unsafe characters
-      def escaper(char):
-         return UNSAFE_URL_CHARS.get(char, char)
-      
-      url = self.__escape_pattern(URL_ENCODING_MATCH, url, escaper)
-      
-      if '//' not in self.allowed_schemes and url.startswith('//'):
-         return None # disallow protocol-relative URLs (possible XSS vector)
+         job = self.executor.submit(self.job, html)
+         self.__call_in_loop(loop, _cancel_job_with, job, future)
+         job.add_done_callback(functools.partial(self.__finish, loop, future))
 
-      parts = url.split(':')
-      scheme = ''
-      if len(parts) > 1:
-         scheme = parts[0]
-         if '/' in scheme or '#' in scheme:
-            scheme = ''
-            url = None
-         else:
-            url = ':'.join(parts[1:])
+   def __finish(self, loop, future, job):
+      with self.lock:
+         self.running -= 1
 
-      if scheme == '':
-         if url == '':
-            return None
-         else:
-            return url
-      elif scheme.lower() in self.allowed_schemes:
-         return '%s:%s' % (scheme, url)
-      else:
-         return None
+      self.__call_in_loop(loop, _copy_job_result, job, future)
+      self.__dispatch()
 
-   def purify_int(self, value):
+   def __call_in_loop(self, loop, function, *args):
       try:
-         return str(int(value))
-      except ValueError:
-         return None
-
-   def purify_set(self, value, allowed_chars):
-      if p2to3isunicode(value, allowed_chars):
-         translation_table = dict.fromkeys(map(ord, allowed_chars), None)
-         if value.translate(translation_table):
-            value = None
-      else:
-         if value.translate(self.trans_table, allowed_chars):
-            value = None
-
-      return value
-   
-   def purify_regex(self, value, regex):
-      if regex.match(value):
-         return value
-      else:
-         return None
-
-   def purify_text(self, value, include_quotes=False):
-      def escaper(char):
-         return self.__escape_data(char, include_quotes)
-      
-      return self.__escape_pattern(ENTITY_MATCH, value, escaper)
-
-def filter_html(html, spec, **kwargs):
-   html_filter = HTMLFilter(spec, **kwargs)
-   return html_filter.filter(html)
-
-
+         loop.call_soon_threadsafe(function, *args)
+      except RuntimeError:
+         pass # the loop is closed, so nothing is waiting for the result
@@ -0,0 +1,333 @@
+"""
+Throughput benchmarks for FilterHTML.
+
+Generates corpora of different shapes (with a fixed seed, so runs are reproducible offline),
+filters them with a few specs, and times the attribute purifiers.
+
+   python benchmarks/run_benchmarks.py                       # print a summary
+   python benchmarks/run_benchmarks.py --json results.json   # also save machine-readable results
+   python benchmarks/run_benchmarks.py --compare results.json  # compare against saved results
+"""
+from __future__ import print_function
+
+import argparse, json, os, platform, random, re, runpy, sys, timeit, tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import FilterHTML
+
+SEED = 1234
+
+WORDS = [
+   'lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit',
+   '&amp;', '&lt;tag&gt;', "don't", '"quoted"', 'semi;colon', 'http://example.com/page',
+   'café', '✓',
+]
+
+URLS = [
+   'http://example.com/',
+   'https://example.com/path/to/page.html?query=1&other=two#fragment',
+   '/relative/path with spaces/file.png',
+   'mailto:someone@example.com',
+   'javascript:alert(1)',
+   '//protocol-relative.example.com/',
+   'ftp://files.example.com/%7Euser/[file].txt',
+   'page.html#section',
+]
+
+COLORS = ['red', 'RED', '#fff', '#f0f0f0', 'rgb(255, 0, 0)', 'rgba(0, 255, 255, 0.5)', 'hsl(40, 20%, 10%)', 'invalid']
+
+STYLES = [
+   'color:red',
+   'color: #f0f0f0',
+   'font-size:12px',
+   'width: 100%',
+   'background-color:rgb(1, 2, 3)',
+   'text-align:center',
+   'position:absolute',
+   'color:\\72 ed',
+]
+
+# pasted from a WYSIWYG editor, with many declarations in each style
+WYSIWYG_STYLES = [
+   'margin: 0px 0px 10px; padding: 0px; color: rgb(51, 51, 51); font-family: "Helvetica Neue", Helvetica, Arial, sans-serif; '
+      'font-size: 14px; line-height: 20px; background-color: rgb(255, 255, 255)',
+   'color: #333333; font-size: 12px; font-weight: bold; text-align: center; width: 100%; background-image: url("http://example.com/a.png")',
+   'font-family: \'Segoe UI\', Tahoma; color: red; font-size: 1.2em; width: 50%; text-align: left; font-style: italic; '
+      'text-decoration: underline; background-color: #f0f0f0',
+   'width: 320px; font-size: 10pt; color: hsl(40, 20%, 10%); text-align: right; line-height: 1.5; margin-left: 2em; white-space: pre-wrap',
+]
+
+SYNTHETIC_SPEC = {
+   'p': {
+      'class': ['lead', 'muted', 'text-center', re.compile(r'^col-\d+$')],
+      'style': {
+         'color': 'color',
+         'text-align': ['left', 'right', 'center'],
+      }
+   },
+   'div': {
+      'class': ['row', 'container', re.compile(r'^col-\d+$')],
+      'id': 'alphanumeric',
+      re.compile(r'^data-[a-z-]+$'): '*',
+   },
+   'span': {
+      'class': ['badge', 'label'],
+      'style': {
+         'color': 'color',
+         'background-color': 'color',
+         'font-size': 'measurement',
+         'width': 'measurement',
+      }
+   },
+   'a': {
+      'href': 'url',
+      'target': ['_blank', '_self'],
+      'title': 'text',
+   },
+   'img': {
+      'src': 'url',
+      'alt': 'text',
+      'width': 'int',
+      'height': 'int',
+   },
+   'b': {},
+   'i': {},
+   'br': {},
+   'strong': 'b',
+   'em': 'i',
+}
+
+# tag filtering functions return a new dictionary for each element, as they usually do
+def link_spec(tag_name, tag_stack):
+   return {
+      'href': 'url',
+      'target': ['_blank', '_self'],
+      'title': 'text',
+      'class': ['btn', 'active'],
+      'style': {
+         'color': 'color',
+         'font-size': 'measurement',
+      }
+   }
+
+def span_spec(tag_name, tag_stack):
+   return {
+      'class': ['badge', 'label'],
+      'style': {
+         'color': 'color',
+         'background-color': 'color',
+         'font-size': 'measurement',
+         'width': 'measurement',
+      }
+   }
+
+DELEGATE_SPEC = dict(SYNTHETIC_SPEC, a=link_spec, span=span_spec)
+
+MINIMAL_SPEC = {
+   'p': {},
+   'b': {},
+   'i': {},
+   'br': {},
+   'a': {
+      'href': 'url',
+   },
+}
+
+def load_bootstrap_spec():
+   namespace = runpy.run_path(os.path.join(ROOT, 'examples', 'bootstrap-2.spec.py'))
+   return namespace['HTML_WHITELIST']
+
+def words(rand, low, high):
+   return ' '.join(rand.choice(WORDS) for _ in range(rand.randint(low, high)))
+
+def text_heavy(rand):
+   return ''.join('<p>%s</p>\n' % words(rand, 50, 200) for _ in range(rand.randint(2, 6)))
+
+def attribute_heavy(rand):
+   parts = []
+   for _ in range(rand.randint(10, 30)):
+      parts.append('<a href="%s" target="_blank" title="%s" onclick="steal()" rel="nofollow" data-x="1">%s</a>' % (
+         rand.choice(URLS), words(rand, 1, 4), words(rand, 1, 3)))
+      parts.append('<img src="%s" alt="%s" width="%d" height="%d" style="border:0">' % (
+         rand.choice(URLS), words(rand, 1, 3), rand.randint(1, 999), rand.randint(1, 999)))
+   return '\n'.join(parts)
+
+def deeply_nested(rand):
+   depth = rand.randint(50, 200)
+   tags = [rand.choice(['div', 'span', 'b', 'i', 'p']) for _ in range(depth)]
+   opening = ''.join('<%s>%s' % (tag, words(rand, 0, 2)) for tag in tags)
+   closing = ''.join('</%s>' % (tag,) for tag in reversed(tags))
+   return opening + closing
+
+def style_class_heavy(rand):
+   parts = []
+   for _ in range(rand.randint(20, 60)):
+      style = ';'.join(rand.choice(STYLES) for _ in range(rand.randint(1, 6)))
+      classes = ' '.join(rand.choice(['lead', 'muted', 'badge', 'label', 'col-4', 'unknown', 'text-center', 'well'])
+         for _ in range(rand.randint(1, 6)))
+      parts.append('<span class="%s" style="%s">%s</span>' % (classes, style, words(rand, 1, 5)))
+   return '\n'.join(parts)
+
+def script_removal_heavy(rand):
+   parts = []
+   for _ in range(rand.randint(5, 20)):
+      parts.append('<p>%s</p>' % words(rand, 5, 20))
+      parts.append('<script>for (var i = 0; i < 10; i++) { if (a << i > b) { x(i); } }</script>')
+      parts.append('<style>.a > .b { color: red; }</style>')
+   return '\n'.join(parts)
+
+CORPORA = [
+   ('text-heavy', text_heavy),
+   ('attribute-heavy', attribute_heavy),
+   ('deeply-nested', deeply_nested),
+   ('style-class-heavy', style_class_heavy),
+   ('script-removal-heavy', script_removal_heavy),
+]
+
+def generate_corpus(generator, size):
+   rand = random.Random(SEED)
+   documents = []
+   total = 0
+   while total < size:
+      document = generator(rand)
+      documents.append(document)
+      total += len(document)
+   return documents
+
+def best_time(func, repeat):
+   return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def peak_memory(func):
+   tracemalloc.start()
+   try:
+      func()
+      return tracemalloc.get_traced_memory()[1]
+   finally:
+      tracemalloc.stop()
+
+def bench_filter(spec_name, spec, corpus_name, documents, repeat):
+   compiled_spec = FilterHTML.compile_spec(spec)
+   html_filter = FilterHTML.HTMLFilter(compiled_spec)
+   num_bytes = sum(len(document.encode('utf-8')) for document in documents)
+
+   def run():
+      for document in documents:
+         html_filter.filter(document)
+
+   seconds = best_time(run, repeat)
+   largest = max(documents, key=len)
+
+   return {
+      'name': 'filter/%s/%s' % (spec_name, corpus_name),
+      'documents': len(documents),
+      'bytes': num_bytes,
+      'seconds': seconds,
+      'mb_per_s': num_bytes / seconds / 1e6,
+      'docs_per_s': len(documents) / seconds,
+      'peak_memory_bytes': peak_memory(lambda: html_filter.filter(largest)),
+   }
+
+def bench_purifier(name, func, values, repeat, loops=200):
+   num_bytes = sum(len(value.encode('utf-8')) for value in values) * loops
+
+   def run():
+      for _ in range(loops):
+         for value in values:
+            func(value)
+
+   seconds = best_time(run, repeat)
+
+   return {
+      'name': name,
+      'calls': len(values) * loops,
+      'bytes': num_bytes,
+      'seconds': seconds,
+      'mb_per_s': num_bytes / seconds / 1e6,
+      'calls_per_s': len(values) * loops / seconds,
+      'peak_memory_bytes': peak_memory(lambda: [func(value) for value in values]),
+   }
+
+def run_benchmarks(size, repeat):
+   specs = [
+      ('bootstrap-2', load_bootstrap_spec()),
+      ('synthetic', SYNTHETIC_SPEC),
+      ('delegates', DELEGATE_SPEC),
+      ('minimal', MINIMAL_SPEC),
+   ]
+
+   results = []
+   for corpus_name, generator in CORPORA:
+      documents = generate_corpus(generator, size)
+      for spec_name, spec in specs:
+         results.append(bench_filter(spec_name, spec, corpus_name, documents, repeat))
+
+   html_filter = FilterHTML.HTMLFilter(SYNTHETIC_SPEC)
+   style_validator = FilterHTML._compile_style_rule(SYNTHETIC_SPEC['span']['style'], html_filter.allowed_schemes)
+
+   schemes = frozenset(html_filter.allowed_schemes)
+
+   # the purifiers themselves, as the memos in front of them would otherwise answer every repeated value
+   results.append(bench_purifier('purify_url', lambda url: FilterHTML._purify_url(url, schemes), URLS, repeat))
+   results.append(bench_purifier('purify_style', lambda style: style_validator(style, 'style'), WYSIWYG_STYLES, repeat))
+   results.append(bench_purifier('purify_color', FilterHTML._purify_color, COLORS, repeat))
+
+   # and the memos, for values which are repeated
+   results.append(bench_purifier('purify_url/memo', html_filter.purify_url, URLS, repeat))
+   results.append(bench_purifier('purify_color/memo', html_filter.purify_color, COLORS, repeat))
+
+   return results
+
+def print_results(results, baseline=None):
+   baseline = dict((result['name'], result) for result in (baseline or []))
+
+   for result in results:
+      line = '%-45s %8.2f MB/s' % (result['name'], result['mb_per_s'])
+      if 'docs_per_s' in result:
+         line += ' %10.0f docs/s' % (result['docs_per_s'],)
+      else:
+         line += ' %10.0f calls/s' % (result['calls_per_s'],)
+      line += ' %8.1f KiB peak' % (result['peak_memory_bytes'] / 1024.0,)
+
+      if result['name'] in baseline:
+         line += ' %+7.1f%%' % ((result['mb_per_s'] / baseline[result['name']]['mb_per_s'] - 1) * 100,)
+
+      print(line)
+
+def main(args=None):
+   parser = argparse.ArgumentParser(description='FilterHTML benchmarks')
+   parser.add_argument('--size', type=int, default=512 * 1024, help='approximate size of each corpus, in characters')
+   parser.add_argument('--repeat', type=int, default=5, help='number of timing runs (the best is reported)')
+   parser.add_argument('--quick', action='store_true', help='small corpora and fewer runs')
+   parser.add_argument('--json', metavar='PATH', help='write results as JSON to PATH')
+   parser.add_argument('--compare', metavar='PATH', help='compare against JSON results from a previous run')
+   args = parser.parse_args(args)
+
+   if args.quick:
+      args.size = 64 * 1024
+      args.repeat = 2
+
+   results = run_benchmarks(args.size, args.repeat)
+
+   baseline = None
+   if args.compare:
+      with open(args.compare) as compare_file:
+         baseline = json.load(compare_file)['results']
+
+   print_results(results, baseline)
+
+   if args.json:
+      with open(args.json, 'w') as json_file:
+         json.dump({
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'seed': SEED,
+            'size': args.size,
+            'repeat': args.repeat,
+            'results': results,
+         }, json_file, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+   main()
@@ -1,6 +1,6 @@
 from __future__ import print_function
 
-import unittest, re
+import unittest, re, os, io
 
 import FilterHTML
 
@@ -10,6 +10,67 @@ def print_diff(expected_html, result):
    d = difflib.Differ()
    print(''.join(d.compare(expected_html, result)))
 
+def run_async(calls):
+   # runs each call with an event loop running, and waits for the awaitables they return
+   import asyncio
+
+   loop = asyncio.new_event_loop()
+   results = loop.create_future()
+
+   def start():
+      gathered = asyncio.gather(*[call() for call in calls], return_exceptions=True)
+      gathered.add_done_callback(lambda gathered: results.set_result(gathered.result()))
+
+   loop.call_soon(start)
+   try:
+      return loop.run_until_complete(results)
+   finally:
+      loop.close()
+
+def pure_tag_spec(tag_name, tag_stack):
+   return {}
+pure_tag_spec.pure = True
+
+ADVERSARIAL_SPEC = {
+   'a': {
+      'href': 'url',
+      'title': 'text',
+      'class': ['x', 'y'],
+      'style': {
+         'color': 'color',
+         'width': 'measurement',
+         'background-image': 'url'
+      }
+   },
+   'b': {},
+   'i': pure_tag_spec,
+   'script': {}
+}
+
+# generators of pathological documents of about n characters, which must still be filtered in linear time
+ADVERSARIAL_INPUTS = {
+   'script full of "<"': lambda n: '<script>' + 'a<b' * (n // 3) + '</script>',
+   'removed style full of "<"': lambda n: '<b><style>' + 'a<x ' * (n // 4) + '</style></b>',
+   'many style declarations': lambda n: '<a style="' + 'color:red;' * (n // 10) + '">x</a>',
+   'unclosed parentheses in a style': lambda n: '<a style="width:' + '(' * n + '">x</a>',
+   'parentheses in a style': lambda n: '<a style="width:' + '()' * (n // 2) + '(">x</a>',
+   'escapes in a style': lambda n: '<a style="color:' + '\\\\' * (n // 2) + 'a">x</a>',
+   'quotes in a style': lambda n: '<a style="width:' + "'" * n + '">x</a>',
+   'long color': lambda n: '<a style="color:rgba(1,1,1,' + '1' * n + 'x)">x</a>',
+   'long url': lambda n: '<a href="http://' + 'a%' * (n // 2) + '">x</a>',
+   'long class': lambda n: '<a class="' + 'x ' * (n // 2) + '">x</a>',
+   'ampersands': lambda n: '&' * n,
+   'short entities': lambda n: '&a' * (n // 2) + ';',
+   'long entity': lambda n: '&' + 'a' * n + ';',
+   'nested tags': lambda n: '<b>' * (n // 7) + '</b>' * (n // 7),
+   'nested tags with a pure tag filter': lambda n: '<i>' * (n // 7) + '</i>' * (n // 7),
+   'many attributes': lambda n: '<a ' + 'title="t" ' * (n // 10) + '>x</a>',
+   'quoted ">" in attributes': lambda n: '<a ' + 'title=">" ' * (n // 10) + '>x</a>',
+   'invalid attribute characters': lambda n: '<a ' + '/' * n + '>x</a>',
+   'unknown tags': lambda n: '<x>' * (n // 3),
+   'escaped text in an attribute': lambda n: '<a title="' + '<&;' * (n // 3) + '">x</a>',
+}
+
 class TestFiltering(unittest.TestCase):
    def test_escape_data(self):
       input_html = "-&gt;"
@@ -257,6 +318,23 @@ class TestFiltering(unittest.TestCase):
 
       self.assertEqual(expected_html, result)
 
+      # literals, patterns and functions together
+      spec['span']['class'] = [
+         'plain',
+         re.compile(r'^col-\d+$'),
+         re.compile(r'^icon-[a-z]+$'),
+      ]
+
+      input_html = '<span class="icon-x col-12 invalid plain  icon-x col-x col-1">x</span>'
+      expected_html = '<span class="icon-x col-12 plain col-1">x</span>'
+
+      self.assertEqual(expected_html, FilterHTML.filter_html(input_html, spec))
+
+      spec['span']['class'].insert(0, lambda value: 'extra' if 'plain' in value else None)
+      expected_html = '<span class="extra icon-x col-12 plain col-1">x</span>'
+
+      self.assertEqual(expected_html, FilterHTML.filter_html(input_html, spec))
+
    def test_styles(self):
       spec = {
          'span': {
@@ -306,6 +384,27 @@ class TestFiltering(unittest.TestCase):
 
       self.assertEqual(expected_html, result)
 
+      # values containing colons, semicolons inside quotes and parentheses, and escapes
+      spec['div']['style'] = {
+         'background-image': re.compile(r'^url\((https?:)?[\w/.:;]+\)$'),
+         'font-family': re.compile(r'^("[\w ;]+"|\w+)(, ?("[\w ;]+"|\w+))*$'),
+         'width': 'measurement',
+         'height': 'measurement'
+      }
+
+      input_html = (
+         '<div style="background-image: url(http://example.com/a;b.png); width:1px">a</div>'
+         '<div style=\'font-family: "Times; New Roman", serif;width:\\31 px;height:2px\'>b</div>'
+         '<div style="width:1px;font-family:\'a\\\'b\'; height: 2px; height:1px:2px;font-family:\'x">c</div>'
+      )
+      expected_html = (
+         '<div style="background-image:url(http://example.com/a;b.png);width:1px;">a</div>'
+         '<div style=\'font-family:"Times; New Roman", serif;height:2px;\'>b</div>'
+         '<div style="width:1px;height:2px;">c</div>'
+      )
+
+      self.assertEqual(expected_html, FilterHTML.filter_html(input_html, spec))
+
    def test_regex_delegates(self):
 
       def filter_color(color):
@@ -667,6 +766,14 @@ class TestFiltering(unittest.TestCase):
 
       self.assertEqual(expected_html, result)
 
+      # text filter output is filtered with the same whitelist, and escaped when it has no tags
+      def mention(text, stack):
+         return text.replace('@js', '<a href="javascript:alert(1)" onclick="x()">@js</a><script>x()</script>')
+
+      html_filter = FilterHTML.HTMLFilter(spec, text_filter=mention)
+      self.assertEqual('a &amp; b &gt; c', html_filter.filter('a &amp; b > c'))
+      self.assertEqual('hi <a href="#">@js</a>!<br>hi <a href="#">@js</a>!', html_filter.filter('hi @js!<br>hi @js!'))
+
    def test_spec_delegate(self):
       def allow_inside_span(tag_name, tag_stack):
          is_inside_span = False
@@ -708,6 +815,47 @@ class TestFiltering(unittest.TestCase):
       result = FilterHTML.filter_html(input_html, spec)
       self.assertEqual(expected_html, result)
 
+   def test_spec_delegate_calls(self):
+      calls = []
+      def link_spec(tag_name, tag_stack):
+         calls.append(tag_name)
+         if 'b' in [name for name, _ in tag_stack]:
+            return None
+         return {'href': 'url', 'title': 'text', 'target': ['_blank']}
+
+      spec = {
+         'a': link_spec,
+         'b': {}
+      }
+
+      input_html = '<a href="http://example.com" title="x" target="_blank">a</a><b><a href="/">b</a></b><a id="x">c</a>'
+      expected_html = '<a href="http://example.com" title="x" target="_blank">a</a><b>b</b><a>c</a>'
+
+      # called once per element, and for closing tags of elements which were left out
+      self.assertEqual(expected_html, FilterHTML.filter_html(input_html, spec))
+      self.assertEqual(['a', 'a', 'a', 'a'], calls)
+
+      # pure functions are called once per tag name and enclosing tag names
+      del calls[:]
+      link_spec.pure = True
+      self.assertEqual(expected_html, FilterHTML.filter_html(input_html, spec))
+      self.assertEqual(['a', 'a'], calls)
+
+      # a new dictionary with the same rules is only compiled once
+      compiled_spec = FilterHTML.compile_spec(spec)
+      first = compiled_spec.compile_tag({'href': 'url', 'style': {'color': 'color'}, 'class': ['x']})
+      self.assertIs(first, compiled_spec.compile_tag({'href': 'url', 'style': {'color': 'color'}, 'class': ['x']}))
+      self.assertIsNot(first, compiled_spec.compile_tag({'href': 'url', 'style': {'color': 'color'}, 'class': ['y']}))
+      self.assertIsNot(first, compiled_spec.compile_tag({'href': 'url', 'style': ['color'], 'class': ['x']}))
+
+      # functions marked pure after a spec is compiled are still called for every element
+      def bold_spec(tag_name, tag_stack):
+         return {}
+
+      compiled_spec = FilterHTML.compile_spec({'b': bold_spec})
+      bold_spec.pure = True
+      self.assertEqual('<b>x</b>', FilterHTML.filter_html('<b>x</b>', compiled_spec))
+
    def test_attribute_wildcard(self):
       spec = {
          'span': {'*': ['just-an-id', 'true', 'something']},
@@ -791,5 +939,924 @@ class TestFiltering(unittest.TestCase):
       self.assertEqual(expected_html, result)
 
 
+   def test_purify_text(self):
+      html_filter = FilterHTML.HTMLFilter({})
+
+      self.assertEqual('plain text', html_filter.purify_text('plain text'))
+      self.assertEqual('it\'s "quoted"', html_filter.purify_text('it\'s "quoted"'))
+      self.assertEqual('it&apos;s &quot;quoted&quot;', html_filter.purify_text('it\'s "quoted"', include_quotes=True))
+      self.assertEqual('&lt;b&gt; &amp; &amp;amp&semi; x&semi;', html_filter.purify_text('<b> & &amp&semi; x;'))
+      self.assertEqual('&amp;&amp; &#39;&amp;x&amp; &amp;&lt;', html_filter.purify_text('&&amp; &#39;&x& &amp;<'))
+      self.assertEqual(u'caf\xe9 &eacute;&amp;', html_filter.purify_text(u'caf\xe9 &eacute;&'))
+
+   def test_purify_color(self):
+      html_filter = FilterHTML.HTMLFilter({})
+
+      valid_colors = ['red', 'RED', '#fff', '#F0f0F0', 'rgb(1, 2, 3)', 'rgb(1%,2%,3%)', 'rgba(1, 2, 3, 0.5)',
+         'hsl(1, 2%, 3%)', 'hsla(1,2%,3%,0.5)']
+      invalid_colors = ['', 'reddish', '#ffff', '#ggg', 'rgb(1, 2)', 'rgba(1, 2, 3)', 'hsl(1%, 2%, 3%)', 'hsla(1, 2%, 3%)', 'url(x)']
+
+      for color in valid_colors:
+         self.assertEqual(color.lower(), html_filter.purify_color(color))
+
+      for color in invalid_colors:
+         self.assertEqual(None, html_filter.purify_color(color))
+
+      spec = {
+         'span': {
+            'style': {
+               'color': 'color'
+            }
+         }
+      }
+
+      FilterHTML.COLOR_MEMO.clear()
+      input_html = '<span style="color: red">a</span><span style="color: #fff">b</span><span style="color: red">c</span>'
+      expected_html = '<span style="color:red;">a</span><span style="color:#fff;">b</span><span style="color:red;">c</span>'
+      self.assertEqual(expected_html, FilterHTML.filter_html(input_html, spec))
+      self.assertEqual(1, FilterHTML.COLOR_MEMO.hits)
+      self.assertEqual(2, FilterHTML.COLOR_MEMO.misses)
+      self.assertEqual(2, FilterHTML.COLOR_MEMO.stats['entries'])
+
+   def test_purify_url(self):
+      html_filter = FilterHTML.HTMLFilter({}, allowed_schemes=('HTTP', 'mailto'))
+
+      self.assertEqual('http://example.com/a%20b%5B1%5D', html_filter.purify_url('http://example.com/a b[1]'))
+      self.assertEqual('HTTP://example.com/%7E%25', html_filter.purify_url('HTTP://example.com/%7E%'))
+      self.assertEqual('/path?q=a%3Cb', html_filter.purify_url('/path?q=a<b'))
+      self.assertEqual('mailto:x@example.com', html_filter.purify_url('mailto:x@example.com'))
+      self.assertEqual(None, html_filter.purify_url('javascript:alert(1)'))
+      self.assertEqual(None, html_filter.purify_url('//example.com'))
+      self.assertEqual(None, html_filter.purify_url(''))
+
+      memo = html_filter.url_memo
+      memo.clear()
+      for _ in range(3):
+         html_filter.purify_url('http://example.com/')
+      self.assertEqual(2, memo.hits)
+      self.assertEqual(1, memo.misses)
+
+      # filters with the same schemes share the memo
+      self.assertTrue(FilterHTML.HTMLFilter({'a': {'href': 'url'}}, allowed_schemes=('HTTP', 'mailto')).url_memo is memo)
+
+   def test_regex_attribute_families(self):
+      spec = {
+         'div': {
+            re.compile(r'^data-(id|index)$'): 'int',
+            re.compile(r'^data-[a-z-]+$'): 'alphanumeric',
+            re.compile(r'^aria-', re.IGNORECASE): ['true', 'false'],
+            re.compile(r'^ng-'): 'text',
+            'title': 'text'
+         }
+      }
+
+      input_html = '<div data-id="12" data-name="x1" data-other="a b" aria-hidden="true" aria-label="x" ng-x="a\'b" on-x="y" title="t">x</div>'
+      expected_html = '<div data-id="12" data-name="x1" aria-hidden="true" ng-x="a&apos;b" title="t">x</div>'
+
+      self.assertEqual(expected_html, FilterHTML.filter_html(input_html, spec))
+      self.assertEqual(expected_html, FilterHTML.filter_html(input_html, spec))
+
+      # the first matching pattern applies
+      spec['div'] = {
+         '^$': [
+            [re.compile(r'^data-(id|index)$'), 'int'],
+            [re.compile(r'^data-'), 'alpha'],
+            [re.compile(r'^data-i'), '*']
+         ]
+      }
+
+      input_html = '<div data-id="1" data-index="x" data-item="a1" data-icon="abc">x</div>'
+      expected_html = '<div data-id="1" data-icon="abc">x</div>'
+
+      self.assertEqual(expected_html, FilterHTML.filter_html(input_html, spec))
+
+   def test_purify_set(self):
+      html_filter = FilterHTML.HTMLFilter({})
+
+      self.assertEqual('abc-d', html_filter.purify_set('abc-d', 'abcd-'))
+      self.assertEqual(None, html_filter.purify_set('abc-e', 'abcd-'))
+      self.assertEqual(']^\\', html_filter.purify_set(']^\\', '\\^]'))
+      self.assertEqual(None, html_filter.purify_set('a\n', 'a'))
+      self.assertEqual('', html_filter.purify_set('', ''))
+      self.assertEqual(None, html_filter.purify_set('a', ''))
+
+   def test_compiled_spec(self):
+      spec = {
+         'p': {
+            'class': [
+               'centered'
+            ]
+         },
+         'a': {
+            'href': 'url',
+            'target': ['_blank', '_self']
+         },
+         'span': {
+            'style': {
+               'color': 'color'
+            }
+         },
+         'br': {},
+         'center': 'p class="centered"'
+      }
+
+      input_html = """
+      <center>centered text</center><br>
+      <a href="ftp://example.com" target="_top">link</a>
+      <a href="http://example.com" target="_blank">link</a>
+      <span style="color:RED;width:10px;">red</span>
+      """
+
+      expected_html = """
+      <p class="centered">centered text</p><br>
+      <a href="#">link</a>
+      <a href="http://example.com" target="_blank">link</a>
+      <span style="color:red;">red</span>
+      """
+
+      compiled_spec = FilterHTML.compile_spec(spec, allowed_schemes=('http', 'https'))
+
+      self.assertEqual(expected_html, FilterHTML.filter_html(input_html, compiled_spec))
+      self.assertEqual(expected_html, FilterHTML.HTMLFilter(compiled_spec).filter(input_html))
+      self.assertEqual(expected_html, FilterHTML.filter_html(input_html, spec, allowed_schemes=('http', 'https')))
+
+      with self.assertRaises(AttributeError):
+         compiled_spec.allowed_schemes = ('javascript',)
+
+      with self.assertRaises(ValueError):
+         FilterHTML.HTMLFilter(compiled_spec, allowed_schemes=('javascript',))
+
+      with self.assertRaises(ValueError):
+         FilterHTML.compile_spec({'b': 'strong', 'strong': 'b'})
+
+      # a spec dictionary is compiled once, and again if it is modified
+      self.assertIs(FilterHTML.HTMLFilter(spec).compiled_spec, FilterHTML.HTMLFilter(spec).compiled_spec)
+      self.assertIsNot(FilterHTML.HTMLFilter(spec).compiled_spec, FilterHTML.HTMLFilter(spec, allowed_schemes=('http',)).compiled_spec)
+
+      spec['span']['style']['width'] = 'measurement'
+      self.assertEqual('<span style="color:red;width:10px;">x</span>',
+         FilterHTML.filter_html('<span style="color:RED;width:10px;">x</span>', spec))
+      spec['a']['target'].append('_top')
+      self.assertEqual('<a target="_top">x</a>', FilterHTML.filter_html('<a target="_top">x</a>', spec))
+
+   def test_regex_attribute_name_pairs(self):
+      spec = {
+         'span': {
+            'class': ['pretty'],
+            '^$': [
+               [re.compile(r'^data-'), ['true', 'false']],
+               [re.compile(r'^aria-'), 'alpha'],
+            ]
+         }
+      }
+
+      input_html = """
+      <span data-one="true" data-two="maybe">Span content</span>
+      <span aria-label="label" aria-hidden="not-alpha">Span content</span>
+      <span class="&#106;">Span content</span>
+      """
+
+      expected_html = """
+      <span data-one="true">Span content</span>
+      <span aria-label="label">Span content</span>
+      <span>Span content</span>
+      """
+
+      result = FilterHTML.filter_html(input_html, spec)
+
+      self.assertEqual(expected_html, result)
+
+
+   def test_streaming(self):
+      spec = {
+         'a': {
+            'href': 'url',
+            'title': 'text'
+         },
+         'b': {},
+         'br': {},
+         'pre': {},
+         'script': 'pre'
+      }
+
+      input_html = """
+      <a href="http://www.example.com" title="a > b">example</a><br>
+      <b>Tom &amp; Jerry</b>
+      <script>if (x < 4) { x = 1 << 2; }</script>
+      <div>removed</div>
+      """
+
+      expected_html = FilterHTML.filter_html(input_html, spec)
+
+      for chunk_size in [1, 2, 3, 7, 64]:
+         chunks = [input_html[i:i + chunk_size] for i in range(0, len(input_html), chunk_size)]
+         result = ''.join(FilterHTML.filter_html_iter(chunks, spec))
+         self.assertEqual(expected_html, result)
+
+      # a tag read again (for a quoted "&gt;" split across chunks) keeps the text before it only once
+      chunks = ['Hello world <a title="1 > 0', ' is true">z</a>']
+      self.assertEqual(FilterHTML.filter_html(''.join(chunks), spec), ''.join(FilterHTML.filter_html_iter(chunks, spec)))
+
+      # every split of documents into two or three chunks gives the same output as filtering them whole
+      for input_html in ['x <a title="a > b">y</a> &amp; z', '<b>&lt;</b> <a href="/" title=">">&</a>\n<script>a < b</script>']:
+         expected_html = FilterHTML.filter_html(input_html, spec)
+         for i in range(len(input_html) + 1):
+            for j in range(i, len(input_html) + 1, 3):
+               chunks = [input_html[:i], input_html[i:j], input_html[j:]]
+               self.assertEqual(expected_html, ''.join(FilterHTML.filter_html_iter(chunks, spec)), chunks)
+
+      html_filter = FilterHTML.HTMLFilter(spec)
+
+      # output is emitted once it's safe, tags and entities are held back until complete
+      self.assertEqual('', html_filter.feed('<b'))
+      self.assertEqual('<b>Tom ', html_filter.feed('>Tom &am'))
+      self.assertEqual('&amp;', html_filter.feed('p;'))
+      self.assertEqual(' Jerry</b>', html_filter.feed(' Jerry</b>'))
+      self.assertEqual('', html_filter.close())
+
+      html_filter.feed('<a title="')
+      with self.assertRaises(FilterHTML.HTMLSyntaxError):
+         html_filter.close()
+
+      html_filter.feed('<b>bold')
+      with self.assertRaises(FilterHTML.TagMismatchError):
+         html_filter.close()
+
+      # the filter can be re-used after a failed document
+      self.assertEqual('<b>ok</b>', html_filter.filter('<b>ok</b>'))
+
+
+   def test_filter_to(self):
+      spec = {
+         'b': {},
+         'a': {
+            'href': 'url'
+         }
+      }
+
+      input_html = '<b>x &amp; y</b> <a href="javascript:x()" onclick="y()">z</a> > \n' * 2000
+      expected_html = '<b>x &amp; y</b> <a href="#">z</a> &gt; \n' * 2000
+
+      class Writer(object):
+         def __init__(self):
+            self.parts = []
+
+         def write(self, data):
+            self.parts.append(data)
+
+      writer = Writer()
+      FilterHTML.filter_html_to(input_html, writer, spec)
+      self.assertEqual(expected_html, ''.join(writer.parts))
+      self.assertTrue(len(writer.parts) > 1)
+
+      output = io.StringIO()
+      FilterHTML.HTMLFilter(spec).filter_to(u'<b>ok</b>', output)
+      self.assertEqual(u'<b>ok</b>', output.getvalue())
+
+      writer = Writer()
+      with self.assertRaises(FilterHTML.TagMismatchError):
+         FilterHTML.filter_html_to('<b>unclosed', writer, spec)
+      self.assertEqual('<b>unclosed', ''.join(writer.parts))
+
+   def test_stats(self):
+      def link_spec(tag_name, tag_stack):
+         return {'href': 'url', 'title': 'text'}
+
+      spec = {
+         'a': link_spec,
+         'span': {
+            'style': {
+               'color': 'color'
+            },
+            'class': ['x']
+         },
+         'input': {
+            'checked': 'boolean'
+         },
+         'b': {}
+      }
+
+      def uppercase(text, stack):
+         return text.upper()
+
+      stats = FilterHTML.FilterStats()
+      html_filter = FilterHTML.HTMLFilter(spec, text_filter=uppercase, stats=stats)
+
+      input_html = (
+         '<a href="http://example.com" onclick="x()" title="t">link</a>'
+         '<span style="color:red" class="y" id>span</span>'
+         '<input checked><input checked /><i>i</i><script>x()</script><b>b</b>'
+      )
+      expected_html = (
+         '<a href="http://example.com" title="t">LINK</a>'
+         '<span style="color:red;">SPAN</span>'
+         '<input checked><input>I<b>B</b>'
+      )
+
+      self.assertEqual(expected_html, html_filter.filter(input_html))
+
+      self.assertEqual(len(input_html), stats.input_chars)
+      self.assertEqual(len(expected_html), stats.output_chars)
+      self.assertEqual(7, stats.tags)
+      self.assertEqual(2, stats.tags_dropped)
+      self.assertEqual(8, stats.attributes)
+      self.assertEqual({'not_allowed': 1, 'invalid_value': 1, 'no_value': 1, 'malformed': 1}, {
+         'not_allowed': stats.attributes_dropped['not_allowed'],
+         'invalid_value': stats.attributes_dropped['invalid_value'],
+         'no_value': stats.attributes_dropped['no_value'],
+         'malformed': stats.attributes_dropped['malformed'],
+      })
+
+      for stage in ['purify_url', 'purify_text', 'purify_style', 'purify_class', 'filter_text', 'text_filter', 'tag_spec', 'process']:
+         self.assertTrue(stats.calls[stage] > 0, stage)
+         self.assertTrue(stats.timings[stage] >= 0, stage)
+
+      self.assertEqual(1, stats.calls['tag_spec'])
+      self.assertEqual(1, stats.calls['process'])
+
+      # the same counts when fed in pieces
+      streamed_stats = FilterHTML.FilterStats()
+      html_filter = FilterHTML.HTMLFilter(spec, text_filter=uppercase, stats=streamed_stats)
+      chunks = [input_html[i:i + 7] for i in range(0, len(input_html), 7)]
+      self.assertEqual(expected_html, ''.join(html_filter.filter_iter(chunks)))
+
+      for key in ['input_chars', 'output_chars', 'tags', 'tags_dropped', 'attributes', 'attributes_dropped']:
+         self.assertEqual(stats.as_dict()[key], streamed_stats.as_dict()[key])
+
+      # documents from a cache count towards the characters in and out
+      cached_stats = FilterHTML.FilterStats()
+      html_filter = FilterHTML.HTMLFilter({'b': {}}, stats=cached_stats, cache=FilterHTML.FilterCache())
+      for _ in range(3):
+         self.assertEqual('<b>x</b>y', html_filter.filter('<b>x</b><i>y</i>'))
+      self.assertEqual(3 * len('<b>x</b><i>y</i>'), cached_stats.input_chars)
+      self.assertEqual(3 * len('<b>x</b>y'), cached_stats.output_chars)
+      self.assertEqual(2, cached_stats.cache_hits)
+      self.assertEqual(2, cached_stats.tags)
+
+   def test_report(self):
+      spec = {
+         'a': {
+            'href': 'url',
+            'title': 'text'
+         },
+         'span': {
+            'style': {
+               'color': 'color'
+            },
+            'class': ['x']
+         },
+         'b': {}
+      }
+
+      input_html = (
+         '<a href="javascript:x()" onclick="x()">link</a>\n'
+         '<span style="color:red" class="y">span</span>\n'
+         '  <i>i</i><script>x()</script><a href="http://example.com/a b">b</a>'
+      )
+      expected_html = (
+         '<a href="#">link</a>\n'
+         '<span style="color:red;">span</span>\n'
+         '  i<a href="http://example.com/a%20b">b</a>'
+      )
+
+      filtered_html, report = FilterHTML.filter_html_report(input_html, spec)
+      self.assertEqual(expected_html, filtered_html)
+
+      self.assertEqual({'i': 1}, dict(report.tags_dropped))
+      self.assertEqual({'script': 1}, dict(report.tags_removed))
+      self.assertEqual({
+         ('a', 'onclick', 'not_allowed', None): 1,
+         ('span', 'class', 'invalid_value', 'list'): 1,
+      }, dict(report.attributes_dropped))
+      self.assertEqual({('a', 'href'): 2}, dict(report.urls_rewritten))
+      self.assertEqual(None, report.events)
+
+      filtered_html, report = FilterHTML.filter_html_report(input_html, spec, events=True)
+      self.assertEqual(expected_html, filtered_html)
+      self.assertEqual([
+         FilterHTML.ReportEvent('url', 'a', 'href', 'rewritten', 'url', 0, 0),
+         FilterHTML.ReportEvent('attribute', 'a', 'onclick', 'not_allowed', None, 0, 0),
+         FilterHTML.ReportEvent('attribute', 'span', 'class', 'invalid_value', 'list', 1, 0),
+         FilterHTML.ReportEvent('tag', 'i', 'i', 'not_allowed', None, 2, 2),
+         FilterHTML.ReportEvent('tag', 'script', 'script', 'removed', None, 2, 10),
+         FilterHTML.ReportEvent('url', 'a', 'href', 'rewritten', 'url', 2, 30),
+      ], report.events)
+
+      # the same events when fed in pieces
+      chunked_report = FilterHTML.FilterReport(events=True)
+      html_filter = FilterHTML.HTMLFilter(spec, report=chunked_report)
+      chunks = [input_html[i:i + 5] for i in range(0, len(input_html), 5)]
+      self.assertEqual(expected_html, ''.join(html_filter.filter_iter(chunks)))
+      self.assertEqual(report.as_dict(), chunked_report.as_dict())
+
+   def test_shared_between_threads(self):
+      import threading
+
+      spec = {
+         'b': {},
+         'a': {
+            'href': 'url'
+         },
+         'style': False
+      }
+
+      html_filter = FilterHTML.HTMLFilter(spec, text_filter=lambda text, stack: text.replace(':)', '<b>:)</b>'))
+
+      documents = [
+         ('<b>%d</b><a href="http://example.com/%d" onclick="x">:)</a>' % (i, i) * 20) + ('<style>%d</style>' % i) + ' after'
+         for i in range(8)
+      ]
+      expected = [
+         ('<b>%d</b><a href="http://example.com/%d"><b>:)</b></a>' % (i, i) * 20) + ' after'
+         for i in range(8)
+      ]
+
+      results = {}
+      errors = []
+      def filter_documents(thread):
+         try:
+            for repeat in range(20):
+               for i, html in enumerate(documents):
+                  if html_filter.filter(html) != expected[i]:
+                     results[thread] = 'mismatch'
+                     return
+
+               # feed a document in pieces, while other threads are filtering and feeding
+               i = (thread + repeat) % len(documents)
+               chunks = [html_filter.feed(documents[i][j:j + 9]) for j in range(0, len(documents[i]), 9)]
+               if ''.join(chunks) + html_filter.close() != expected[i]:
+                  results[thread] = 'mismatch'
+                  return
+
+            results[thread] = 'ok'
+         except Exception as error:
+            errors.append(error)
+
+      threads = [threading.Thread(target=filter_documents, args=(thread,)) for thread in range(4)]
+      for thread in threads:
+         thread.start()
+      for thread in threads:
+         thread.join()
+
+      self.assertEqual([], errors)
+      self.assertEqual(dict((thread, 'ok') for thread in range(4)), results)
+
+   def test_filter_async(self):
+      spec = {
+         'b': {},
+      }
+
+      documents = ['<b>%d</b><i>x</i>' % i for i in range(6)] + ['<b>unclosed']
+      expected = ['<b>%d</b>x' % i for i in range(6)]
+
+      for processes in [False, True]:
+         async_filter = FilterHTML.AsyncFilter(spec, workers=2, processes=processes, max_jobs=1, inline_size=0)
+         try:
+            results = run_async([lambda html=html: async_filter.filter(html) for html in documents])
+         finally:
+            async_filter.shutdown()
+
+         self.assertEqual(expected, results[:-1])
+         self.assertTrue(isinstance(results[-1], FilterHTML.TagMismatchError))
+
+      # short documents are filtered straight away, and the same results come from the shared executor
+      html_filter = FilterHTML.HTMLFilter(spec)
+      results = run_async([
+         lambda: FilterHTML.AsyncFilter(spec, inline_size=100).filter(documents[0]),
+         lambda: FilterHTML.filter_html_async(documents[1], spec, inline_size=0),
+         lambda: html_filter.afilter(documents[2]),
+      ])
+      self.assertEqual(expected[:3], results)
+
+      # afilter counts into the filter's stats and report
+      stats, report = FilterHTML.FilterStats(), FilterHTML.FilterReport()
+      html_filter = FilterHTML.HTMLFilter(spec, stats=stats, report=report)
+      self.assertEqual(expected[:1], run_async([lambda: html_filter.afilter(documents[0])]))
+      self.assertEqual(2, stats.tags)
+      self.assertEqual({'i': 1}, dict(report.tags_dropped))
+
+      # worker processes can't send back what they count
+      with self.assertRaises(ValueError):
+         FilterHTML.AsyncFilter(spec, processes=True, stats=stats)
+
+   def test_filter_async_timeout(self):
+      import asyncio, threading
+
+      release = threading.Event()
+      filtered = []
+      def blocking_filter(text, stack):
+         release.wait(5)
+         filtered.append(text)
+         return text
+
+      async_filter = FilterHTML.AsyncFilter({}, max_jobs=1, inline_size=0, text_filter=blocking_filter)
+
+      def release_later():
+         asyncio.get_event_loop().call_later(0.2, release.set)
+         return async_filter.filter('first')
+
+      try:
+         results = run_async([
+            release_later,
+            lambda: async_filter.filter('second', timeout=0.05),
+         ])
+      finally:
+         async_filter.shutdown()
+
+      self.assertEqual('first', results[0])
+      self.assertTrue(isinstance(results[1], asyncio.TimeoutError))
+
+      # the second document timed out before it could be filtered
+      self.assertEqual(['first'], filtered)
+
+   def test_filter_bytes(self):
+      spec = {
+         'b': {},
+         'a': {
+            'href': 'url'
+         }
+      }
+
+      input_html = u'<b>caf\xe9 \u2713</b> <a href="http://example.com/\xe9" onclick="x">&amp; <i>x</i></a>'
+      expected_html = u'<b>caf\xe9 \u2713</b> <a href="http://example.com/\xe9">&amp; x</a>'
+
+      html_filter = FilterHTML.HTMLFilter(spec)
+      data = input_html.encode('utf-8')
+      for value in [data, bytearray(data), memoryview(data)]:
+         self.assertEqual(expected_html.encode('utf-8'), html_filter.filter_bytes(value))
+
+      self.assertEqual(expected_html.encode('utf-16'), FilterHTML.filter_html_bytes(input_html.encode('utf-16'), spec, encoding='utf-16'))
+
+      # split in the middle of multi-byte characters
+      for size in [1, 2, 5]:
+         chunks = [data[i:i + size] for i in range(0, len(data), size)]
+         self.assertEqual(expected_html.encode('utf-8'), b''.join(html_filter.filter_bytes_iter(chunks)))
+
+      invalid = b'<b>\xff</b>'
+      with self.assertRaises(UnicodeDecodeError):
+         html_filter.filter_bytes(invalid)
+      self.assertEqual(invalid, html_filter.filter_bytes(invalid, errors='surrogateescape'))
+
+   def test_limits(self):
+      spec = {
+         'b': {},
+         'a': {
+            'href': 'url',
+            'title': 'text'
+         }
+      }
+
+      def limit_error(html, **limits):
+         html_filter = FilterHTML.HTMLFilter(spec, limits=FilterHTML.FilterLimits(**limits))
+         with self.assertRaises(FilterHTML.LimitExceededError) as context:
+            html_filter.filter(html)
+         return context.exception.limit, context.exception.line, context.exception.column
+
+      self.assertEqual(('max_input', 1, 2), limit_error('<b>\nxyz</b>', max_input=6))
+      self.assertEqual(('max_depth', 1, 3), limit_error('<b><b>\n<b><b>x</b></b></b></b>', max_depth=3))
+      self.assertEqual(('max_attributes', 0, 4), limit_error('<b>x<a href="#" title="t" x=1>y</a></b>', max_attributes=2))
+      self.assertEqual(('max_value_length', 0, 0), limit_error('<a href="http://example.com/' + 'x' * 100 + '"></a>', max_value_length=64))
+
+      # within the limits
+      limits = FilterHTML.FilterLimits(max_input=100, max_depth=4, max_attributes=2, max_value_length=64, max_text_expansion=2, time_limit=10)
+      html = '<b><b><b><a href="http://example.com" title="t">x</a></b></b></b>'
+      self.assertEqual(html, FilterHTML.filter_html(html, spec, limits=limits))
+
+      def expand(text, stack):
+         return text * 10
+
+      html_filter = FilterHTML.HTMLFilter(spec, text_filter=expand, limits=FilterHTML.FilterLimits(max_text_expansion=2))
+      self.assertEqual('x' * 10, html_filter.filter('x'))
+      with self.assertRaises(FilterHTML.LimitExceededError) as context:
+         html_filter.filter('<b>' + 'x' * 100 + '</b>')
+      self.assertEqual('max_text_expansion', context.exception.limit)
+
+      def slow(text, stack):
+         import time
+         time.sleep(0.02)
+         return text
+
+      html_filter = FilterHTML.HTMLFilter(spec, text_filter=slow, limits=FilterHTML.FilterLimits(time_limit=0.05))
+      with self.assertRaises(FilterHTML.LimitExceededError) as context:
+         html_filter.filter('<b>x</b>' * 10)
+      self.assertEqual('time_limit', context.exception.limit)
+
+      # the deadline is also checked while scanning tags
+      html_filter = FilterHTML.HTMLFilter(spec, limits=FilterHTML.FilterLimits(time_limit=0))
+      with self.assertRaises(FilterHTML.LimitExceededError) as context:
+         html_filter.filter('<b></b>' * 100)
+      self.assertEqual('time_limit', context.exception.limit)
+
+      # tags added by a text filter are within the same limits
+      def urlize(text, stack):
+         return '<a href="http://example.com/%s">link</a>' % (text,)
+
+      html_filter = FilterHTML.HTMLFilter(spec, text_filter=urlize, limits=FilterHTML.FilterLimits(max_value_length=64))
+      with self.assertRaises(FilterHTML.LimitExceededError) as context:
+         html_filter.filter('x' * 5000)
+      self.assertEqual('max_value_length', context.exception.limit)
+
+      def embolden(text, stack):
+         return '<b>' + text + '</b>' if text else text
+
+      html_filter = FilterHTML.HTMLFilter(spec, text_filter=embolden, limits=FilterHTML.FilterLimits(max_depth=3))
+      self.assertEqual('<b><b><b>x</b></b></b>', html_filter.filter('<b><b>x</b></b>'))
+      with self.assertRaises(FilterHTML.LimitExceededError) as context:
+         html_filter.filter('<b><b><b>x</b></b></b>')
+      self.assertEqual('max_depth', context.exception.limit)
+
+      html_filter = FilterHTML.HTMLFilter(spec, text_filter=lambda text, stack: '<b></b>' * 100,
+         limits=FilterHTML.FilterLimits(time_limit=0))
+      with self.assertRaises(FilterHTML.LimitExceededError) as context:
+         html_filter.filter('x')
+      self.assertEqual('time_limit', context.exception.limit)
+
+      # fed in chunks, only the time spent filtering counts towards the time limit
+      import time
+      html_filter = FilterHTML.HTMLFilter(spec, limits=FilterHTML.FilterLimits(time_limit=0.05))
+      self.assertEqual('<b>x', html_filter.feed('<b>x'))
+      time.sleep(0.1)
+      self.assertEqual('</b>', html_filter.feed('</b>') + html_filter.close())
+
+      # fed in chunks, the input limit applies to the whole document
+      html_filter = FilterHTML.HTMLFilter(spec, limits=FilterHTML.FilterLimits(max_input=20))
+      with self.assertRaises(FilterHTML.LimitExceededError):
+         list(html_filter.filter_iter(['<b>1234567</b>'] * 3))
+
+      # and limit errors are reported in batches
+      results = list(FilterHTML.filter_many(['<b>x</b>', '<b>' * 5 + '</b>' * 5], spec, limits=FilterHTML.FilterLimits(max_depth=3)))
+      self.assertEqual('<b>x</b>', results[0].html)
+      self.assertTrue(isinstance(results[1].error, FilterHTML.LimitExceededError))
+
+   def test_linear_time(self):
+      import timeit
+
+      html_filter = FilterHTML.HTMLFilter(ADVERSARIAL_SPEC)
+
+      def feed(html):
+         return ''.join([html_filter.feed(html[i:i + 7]) for i in range(0, len(html), 7)]) + html_filter.close()
+
+      size = 5000
+      for name, generate in sorted(ADVERSARIAL_INPUTS.items()):
+         small, large = generate(size), generate(size * 8)
+         self.assertEqual(html_filter.filter(large), feed(large), name)
+
+         for filter_function in [html_filter.filter, feed]:
+            small_time = min(timeit.repeat(lambda: filter_function(small), number=1, repeat=3))
+            large_time = min(timeit.repeat(lambda: filter_function(large), number=1, repeat=3))
+
+            # 8 times the input should take about 8 times as long (where quadratic time would take 64 times)
+            self.assertTrue(large_time < small_time * 20 + 0.002, '%s: %.4fs then %.4fs' % (name, small_time, large_time))
+
+      # the location of each report event is found without counting lines from the start again
+      html_filter = FilterHTML.HTMLFilter(ADVERSARIAL_SPEC, report=FilterHTML.FilterReport(events=True))
+      small, large = '<x>y</x>\n' * (size // 9), '<x>y</x>\n' * (size * 8 // 9)
+      for filter_function in [html_filter.filter, feed]:
+         small_time = min(timeit.repeat(lambda: filter_function(small), number=1, repeat=3))
+         large_time = min(timeit.repeat(lambda: filter_function(large), number=1, repeat=3))
+         self.assertTrue(large_time < small_time * 20 + 0.002, 'report events: %.4fs then %.4fs' % (small_time, large_time))
+
+   def test_repair(self):
+      spec = {
+         'b': {},
+         'i': {},
+         'p': {},
+         'strong': 'b'
+      }
+
+      cases = [
+         ('<b>unclosed', '<b>unclosed</b>'),
+         ('<p><b>x</p>y', '<p><b>x</b></p>y'),
+         ('</b>stray<i>x</i></p>', 'stray<i>x</i>'),
+         ('<p><b><i>x</p></b>', '<p><b><i>x</i></b></p>'),
+         ('<strong>x</b><i>', '<b>x</b><i></i>'),
+         ('<b>ok</b>', '<b>ok</b>'),
+      ]
+
+      html_filter = FilterHTML.HTMLFilter(spec, repair=True)
+      for input_html, expected_html in cases:
+         self.assertEqual(expected_html, html_filter.filter(input_html))
+         self.assertEqual(expected_html, ''.join(html_filter.filter_iter([input_html[i:i + 2] for i in range(0, len(input_html), 2)])))
+
+         # without repair, these raise
+         if input_html != expected_html:
+            with self.assertRaises(FilterHTML.TagMismatchError):
+               FilterHTML.filter_html(input_html, spec)
+
+      filtered_html, report = FilterHTML.filter_html_report('<p><b><i>x</p>\n</b><i>y', spec, repair=True, events=True)
+      self.assertEqual('<p><b><i>x</i></b></p>\n<i>y</i>', filtered_html)
+      self.assertEqual({
+         ('i', 'closed_implicitly'): 1,
+         ('b', 'closed_implicitly'): 1,
+         ('b', 'dropped_closing_tag'): 1,
+         ('i', 'closed_at_end'): 1,
+      }, dict(report.repairs))
+      self.assertEqual([
+         FilterHTML.ReportEvent('repair', 'i', 'i', 'closed_implicitly', None, 0, 10),
+         FilterHTML.ReportEvent('repair', 'b', 'b', 'closed_implicitly', None, 0, 10),
+         FilterHTML.ReportEvent('repair', 'b', 'b', 'dropped_closing_tag', None, 1, 0),
+         FilterHTML.ReportEvent('repair', 'i', 'i', 'closed_at_end', None, 1, 8),
+      ], report.events)
+
+      # an unclosed script is closed at the end, with its contents left as they are whether or not it's streamed
+      for script_spec, expected_html in [
+         ({'script': {}}, '<script>if (a < b) x();</script>'),
+         ({'script': 'pre', 'pre': {}}, '<pre>if (a &lt; b) x()&semi;</pre>'),
+      ]:
+         html_filter = FilterHTML.HTMLFilter(script_spec, repair=True)
+         input_html = '<script>if (a < b) x();'
+         self.assertEqual(expected_html, html_filter.filter(input_html))
+         for chunk_size in [1, 3, 64]:
+            chunks = [input_html[i:i + chunk_size] for i in range(0, len(input_html), chunk_size)]
+            self.assertEqual(expected_html, ''.join(html_filter.filter_iter(chunks)))
+
+      # text filter output is repaired too
+      html_filter = FilterHTML.HTMLFilter(spec, repair=True, text_filter=lambda text, stack: text.replace('x', '<i>x'))
+      self.assertEqual('<b><i>x</i></b>', html_filter.filter('<b>x</b>'))
+
+      # repaired output isn't shared with filters which don't repair
+      self.assertNotEqual(FilterHTML.spec_fingerprint(spec), FilterHTML.spec_fingerprint(spec, repair=True))
+
+   def test_validate(self):
+      spec = {
+         'a': {
+            'href': 'url',
+            'onclick': '^$'
+         },
+         'b': {},
+         'p': {
+            'style': {
+               'color': 'color'
+            }
+         },
+         'style': False,
+         'strong': 'b'
+      }
+
+      cases = [
+         ('<b>bold</b> &amp; <a href="http://example.com">link</a>', None),
+         ('<p style="color:red;">x</p>\n<b></b><b></b>', None),
+         ('<b>x</b> <a onclick="steal()">y</a>', ('invalid_value', 'a', 'onclick', 0, 9)),
+         ('<b>x</b>\n<i>y</i>', ('not_allowed', 'i', 'i', 1, 0)),
+         ('<a href="javascript:steal()">x</a>', ('rewritten', 'a', 'href', 0, 0)),
+         ('<style>b {}</style>', ('removed', 'style', 'style', 0, 0)),
+         ('<b>x &amp; y > z</b>', ('text_changed', None, None, 0, 13)),
+         ('<b >x</b>', ('tag_rewritten', None, None, 0, 0)),
+         ('<b>x</b><p  style="color:red;">y</p>', ('tag_rewritten', None, None, 0, 8)),
+         ('<strong>x</strong>', ('tag_rewritten', None, None, 0, 0)),
+         ('<!-- x -->', ('tag_rewritten', None, None, 0, 0)),
+         ('<b>x', ('tags_not_closed', 'b', None, 0, 4)),
+         ('<b>x</p>', ('tag_mismatch', None, None, 0, 4)),
+      ]
+
+      html_filter = FilterHTML.HTMLFilter(spec)
+      for input_html, expected in cases:
+         if expected is not None:
+            expected = FilterHTML.Violation(*expected)
+         self.assertEqual(expected, html_filter.validate(input_html))
+         self.assertEqual(expected is None, html_filter.is_clean(input_html))
+
+         # clean exactly when filtering changes nothing
+         try:
+            is_unchanged = html_filter.filter(input_html) == input_html
+         except FilterHTML.TagMismatchError:
+            is_unchanged = False
+         self.assertEqual(is_unchanged, expected is None)
+
+      # tags seen before are remembered only where they're clean in the same way
+      self.assertFalse(html_filter.is_clean('<b></b></b>'))
+      self.assertFalse(FilterHTML.HTMLFilter(spec, repair=True).is_clean('<b></b></b>'))
+      self.assertFalse(FilterHTML.HTMLFilter({'b': {}, 'i': pure_tag_spec}).is_clean('<i></i><b><i class="x"></i></b>'))
+
+      def link_spec(tag_name, tag_stack):
+         if any(name == 'b' for name, _ in tag_stack):
+            return None
+         return {'href': 'url'}
+
+      input_html = '<a href="/">x</a><b><a href="/">y</a></b>'
+      html_filter = FilterHTML.HTMLFilter({'a': link_spec, 'b': {}})
+      self.assertEqual('<a href="/">x</a><b>y</b>', html_filter.filter(input_html))
+      self.assertFalse(html_filter.is_clean(input_html))
+
+      html_filter = FilterHTML.HTMLFilter(spec, limits=FilterHTML.FilterLimits(max_depth=2))
+      self.assertTrue(html_filter.is_clean('<b><b></b></b>'))
+      with self.assertRaises(FilterHTML.LimitExceededError):
+         html_filter.validate('<b><b></b><b><b></b></b></b>')
+
+   def test_filter_many(self):
+      spec = {
+         'b': {},
+         'a': {
+            'href': 'url'
+         }
+      }
+
+      documents = [
+         '<b>bold</b>',
+         '<b>unclosed',
+         '<a href="javascript:alert(1)">link</a>',
+         '<a href="x',
+      ] * 20
+
+      for workers in [None, 2]:
+         results = list(FilterHTML.filter_many(documents, spec, workers=workers, chunksize=3))
+
+         self.assertEqual(len(documents), len(results))
+         self.assertEqual(('<b>bold</b>', None), results[0])
+         self.assertEqual(None, results[1].html)
+         self.assertIsInstance(results[1].error, FilterHTML.TagMismatchError)
+         self.assertEqual(('<a href="#">link</a>', None), results[2])
+         self.assertIsInstance(results[3].error, FilterHTML.HTMLSyntaxError)
+         self.assertEqual([str(result) for result in results[:4]] * 20, [str(result) for result in results])
+
+      html_filter = FilterHTML.HTMLFilter(spec)
+      batch_results = list(html_filter.filter_batch(documents))
+      self.assertEqual([str(result) for result in results], [str(result) for result in batch_results])
+
+
+   def test_cache(self):
+      spec = {
+         'b': {},
+         'a': {
+            'href': 'url'
+         },
+         'span': {
+            'class': [re.compile(r'^icon-[a-z]+$')]
+         }
+      }
+
+      cache = FilterHTML.FilterCache(FilterHTML.MemoryCache(max_entries=2))
+      html_filter = FilterHTML.HTMLFilter(spec, cache=cache)
+
+      input_html = '<b>bold</b><a href="javascript:alert(1)">link</a><span class="icon-x y">icon</span>'
+      expected_html = '<b>bold</b><a href="#">link</a><span class="icon-x">icon</span>'
+
+      self.assertEqual(expected_html, html_filter.filter(input_html))
+      self.assertEqual(expected_html, html_filter.filter(input_html))
+      self.assertEqual(expected_html, FilterHTML.filter_html(input_html, spec, cache=cache))
+      self.assertEqual(2, cache.hits)
+      self.assertEqual(1, cache.misses)
+
+      # least recently used entries are evicted
+      html_filter.filter('<b>1</b>')
+      html_filter.filter('<b>2</b>')
+      html_filter.filter(input_html)
+      self.assertEqual(2, cache.hits)
+      self.assertEqual(4, cache.misses)
+
+      # errors aren't cached
+      with self.assertRaises(FilterHTML.TagMismatchError):
+         html_filter.filter('<b>')
+      with self.assertRaises(FilterHTML.TagMismatchError):
+         html_filter.filter('<b>')
+
+      # fingerprints depend on the spec and options
+      fingerprint = FilterHTML.spec_fingerprint(spec)
+      self.assertEqual(fingerprint, FilterHTML.spec_fingerprint(dict(spec)))
+      self.assertEqual(fingerprint, FilterHTML.spec_fingerprint(FilterHTML.compile_spec(spec)))
+      self.assertNotEqual(fingerprint, FilterHTML.spec_fingerprint(spec, allowed_schemes=('http',)))
+      self.assertNotEqual(fingerprint, FilterHTML.spec_fingerprint(spec, remove=['script']))
+      self.assertNotEqual(fingerprint, FilterHTML.spec_fingerprint({'b': {}, 'a': {'href': 'url'}, 'span': {}}))
+      self.assertNotEqual(fingerprint, FilterHTML.spec_fingerprint(spec, limits=FilterHTML.FilterLimits(max_depth=3)))
+      self.assertEqual(fingerprint, FilterHTML.spec_fingerprint(spec, limits=FilterHTML.FilterLimits(max_input=100)))
+
+      # output isn't shared with a filter which would raise LimitExceededError for it
+      deep_html = '<b>' * 50 + '</b>' * 50
+      FilterHTML.HTMLFilter(spec, cache=cache).filter(deep_html)
+      with self.assertRaises(FilterHTML.LimitExceededError):
+         FilterHTML.HTMLFilter(spec, cache=cache, limits=FilterHTML.FilterLimits(max_depth=3)).filter(deep_html)
+
+      # functions without a fingerprint can't be cached
+      def uppercase(text, stack):
+         return text.upper()
+
+      self.assertEqual(None, FilterHTML.spec_fingerprint(spec, text_filter=uppercase))
+      self.assertEqual(None, FilterHTML.spec_fingerprint({'b': lambda tag_name, stack: {}}))
+
+      html_filter = FilterHTML.HTMLFilter(spec, text_filter=uppercase, cache=cache)
+      self.assertEqual('<b>BOLD</b>', html_filter.filter('<b>bold</b>'))
+      self.assertEqual(1, cache.skipped)
+
+      uppercase.fingerprint = 'uppercase-v1'
+      self.assertNotEqual(None, FilterHTML.spec_fingerprint(spec, text_filter=uppercase))
+
+   def test_file_cache(self):
+      import shutil, tempfile
+
+      directory = tempfile.mkdtemp()
+      try:
+         cache = FilterHTML.FilterCache(FilterHTML.FileCache(directory, max_entries=10))
+         html_filter = FilterHTML.HTMLFilter({'b': {}}, cache=cache)
+
+         for i in range(20):
+            self.assertEqual('<b>%d</b>\n' % (i,), html_filter.filter('<b>%d</b>\n' % (i,)))
+
+         self.assertEqual('<b>19</b>\n', html_filter.filter('<b>19</b>\n'))
+         self.assertEqual(1, cache.hits)
+         self.assertTrue(len(os.listdir(directory)) <= 10)
+      finally:
+         shutil.rmtree(directory)
+
+
 if __name__ == '__main__':
     unittest.main()